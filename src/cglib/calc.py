@@ -4,30 +4,62 @@ from cglib.index import index2d_to_cartesians_coo, edge_1d_to_3d_index, edge_3d_
 
 
 
-ti.init(arch = ti.cpu)
+@ti.func
+def sign_bit(value: float)\
+             -> int: 
+    '''
+    Gives 1 if the value is positive or zero, 0 if it is negative. Every 
+    classification of the grid values goes through this function, so that 
+    the binary grid, the configurations and the points always agree. 
+
+    It is a single comparison, which vectorises, rather than a test of the 
+    IEEE sign bit: -0. has its sign bit set but is equal to zero, 
+    and zero values take the value 1. 
+
+    Parameters 
+    -------
+
+    value: float
+
+        value of the scalar field
+
+
+    Returns
+    -------
 
+    int
 
+        1 or 0
+    '''
+    return ti.cast(value >= 0., int)
 
 @ti.func
-def linear_interpolation(grid: ti.template(), 
-                         point_0_index : ti.math.ivec2, 
-                         point_1_index: ti.math.ivec2, 
-                         value: float)\
-                         -> ti.math.vec2: 
+def linear_interpolation_of_values(grid_shape: ti.math.ivec2, 
+                                   point_0_index : ti.math.ivec2, 
+                                   point_1_index: ti.math.ivec2, 
+                                   value_0: float, 
+                                   value_1: float, 
+                                   value: float)\
+                                   -> ti.math.vec2: 
     '''
     Find the point on a segment where a function, or a scalar field is equal to the value in argument
-    by approximating this function by a linear function. 
+    by approximating this function by a linear function. The caller reads the values 
+    of the scalar field at both ends of the segment. 
 
     Parameters 
     -------
 
-    grid: ti.template 
+    grid_shape: ti.math.ivec2
 
-        the 2D field containing the scalar field values. 
+        2D shape of the scalar field grid
 
     point_0_index, point_1_index: ti.math.ivec2
 
         the 2D index of the grid points forming the segment. 
+
+    value_0, value_1: float
+
+        the values of the scalar field at these grid points. 
         value : value whose abscissa we want to find on the segment. 
 
     Returns
@@ -39,29 +71,16 @@ def linear_interpolation(grid: ti.template(),
         in the scalar field is equal to the value passed as an argument. 
     '''
 
-    point_0 = index2d_to_cartesians_coo(ti.math.ivec2(grid.shape[0], grid.shape[1]), 
+    point_0 = index2d_to_cartesians_coo(grid_shape, 
                                         point_0_index)
-    point_1 = index2d_to_cartesians_coo(ti.math.ivec2(grid.shape[0],grid.shape[1]), 
+    point_1 = index2d_to_cartesians_coo(grid_shape, 
                                         point_1_index)
-    
-    res_x = 0.
-    res_y = 0.
-
-
-    if point_0_index.y == point_1_index.y: 
-        res_x = point_0.x + (value-grid[point_0_index.x, point_0_index.y]) *\
-              (point_1.x - point_0.x) / (grid[point_1_index.x, point_1_index.y]\
-                                         -grid[point_0_index.x, point_0_index.y])
-        res_y = point_1.y
 
-    else: 
-        res_y = point_0.y + (value-grid[point_0_index.x, point_0_index.y]) *\
-              (point_1.y - point_0.y) / (grid[point_1_index.x, point_1_index.y]\
-                                         -grid[point_0_index.x, point_0_index.y])
-        res_x = point_0.x
+    #the segment is either horizontal or vertical, so the coordinate which 
+    #does not change is kept as is by the vector form, without any branch
+    ratio = (value - value_0) / (value_1 - value_0)
 
-    return ti.math.vec2(res_x, 
-                        res_y)
+    return point_0 + ratio * (point_1 - point_0)
 
 @ti.func
 def euclidean_norm(vector: ti.math.vec2)\
@@ -85,19 +104,211 @@ def euclidean_norm(vector: ti.math.vec2)\
 
         his Euclidean norm. 
     '''
-    return ti.math.sqrt(vector.x **2 + vector.y**2)
+    return ti.math.sqrt(euclidean_norm_sqr(vector))
+
+@ti.func
+def euclidean_norm_sqr(vector: ti.math.vec2)\
+                     -> float: 
+
+    '''
+    Calculate the squared Euclidean norm of a two-dimensional vector, 
+    without any square root. 
+
+    Parameters 
+    -------
+
+    vector : ti.math.vec2
+
+        the two-dimensionnal vector
+    
+
+    Returns
+    -------
+
+    float: 
+
+        his squared Euclidean norm. 
+    '''
+    return vector.x * vector.x + vector.y * vector.y
+
+@ti.func
+def sum_of_euclidean_norms(vector_0: ti.math.vec2, 
+                           vector_1: ti.math.vec2)\
+                           -> float: 
+
+    '''
+    Calculate the sum of the Euclidean norms of two two-dimensional vectors. 
+    Both vectors are packed in a single 4D vector so that the four squares 
+    are computed by one SIMD multiplication. 
+
+    Parameters 
+    -------
+
+    vector_0, vector_1 : ti.math.vec2
+
+        the two-dimensionnal vectors
+    
+
+    Returns
+    -------
+
+    float: 
+
+        the sum of their Euclidean norms. 
+    '''
+    packed = ti.math.vec4(vector_0.x, vector_0.y, vector_1.x, vector_1.y)
+    squared = packed * packed
+
+    return ti.math.sqrt(squared.x + squared.y) + ti.math.sqrt(squared.z + squared.w)
+
+@ti.func
+def pack_energy_and_index(energy: float, 
+                          index: int)\
+                          -> ti.u64: 
+
+    '''
+    Pack an energy and an index in a single 64-bit unsigned integer such that 
+    comparing two packed values compares the energies first, then the indexes. 
+    The minimum of packed values thus gives both the minimal energy and its index, 
+    with the smallest index in case of equality. 
+
+    Parameters 
+    -------
+
+    energy : float
+
+        the energy, stored as a 32-bit float in the upper half. 
+
+    index : int
+
+        a non-negative index, stored in the lower half. 
+    
+
+    Returns
+    -------
+
+    ti.u64: 
+
+        the packed value. 
+    '''
+    bits = ti.bit_cast(ti.cast(energy, ti.f32), ti.u32)
+
+    #flip all the bits of negative floats and only the sign bit of positive ones, 
+    #so that the unsigned order matches the float order
+    mask = (ti.u32(0) - (bits >> 31)) | (ti.u32(1) << 31)
+
+    return (ti.cast(bits ^ mask, ti.u64) << 32) | ti.cast(index, ti.u64)
+
+@ti.func
+def unpack_energy(packed: ti.u64)\
+                  -> float: 
+
+    '''
+    Get back the energy stored by pack_energy_and_index. 
+
+    Parameters 
+    -------
+
+    packed : ti.u64
+
+        the packed value. 
+    
+
+    Returns
+    -------
+
+    float: 
+
+        the energy. 
+    '''
+    bits = ti.cast(packed >> 32, ti.u32)
+    mask = ((bits >> 31) - ti.u32(1)) | (ti.u32(1) << 31)
+
+    return ti.bit_cast(bits ^ mask, ti.f32)
+
+@ti.func
+def unpack_index(packed: ti.u64)\
+                 -> int: 
+
+    '''
+    Get back the index stored by pack_energy_and_index. 
+
+    Parameters 
+    -------
+
+    packed : ti.u64
+
+        the packed value. 
+    
+
+    Returns
+    -------
+
+    int: 
+
+        the index. 
+    '''
+    return ti.cast(packed & ((ti.u64(1) << 32) - ti.u64(1)), int)
 
 @ti.func
-def compute_all_energies(points: ti.template(), 
-                         next_edge: ti.template(), 
-                         cycle_index: ti.template(), 
-                         energies: ti.template(), 
-                         current_edge_1d_index: int): 
+def find_cycle_root(cycle_parent: ti.template(), 
+                    cycle: int) -> int: 
+    '''
+    Find the cycle in which a cycle has been stitched, by following the 
+    parents up to a cycle which is its own parent. The path is halved on 
+    the way, so that the next searches are shorter. 
+
+    Parameters 
+    -------
+
+    cycle_parent : ti.template
+
+        1D field containing the cycle in which each cycle has been stitched, 
+        or the cycle itself if it has not been stitched. 
+
+    cycle : int
+
+        index of a cycle, or -1. 
+
+        
+    Returns
+    -------
+
+    int 
+
+        index of the cycle currently holding the points of cycle, -1 if cycle is -1
+    '''
+    root = cycle
+
+    if root != -1: 
+        while cycle_parent[root] != root: 
+            #every write is an ancestor of root, concurrent halvings are safe
+            cycle_parent[root] = cycle_parent[cycle_parent[root]]
+            root = cycle_parent[root]
+
+    return root
+
+@ti.kernel
+def compute_cycle_energies(points: ti.template(), 
+                           next_edge: ti.template(), 
+                           cycle_index: ti.template(), 
+                           cycle_parent: ti.template(), 
+                           cycle_edges: ti.template(), 
+                           cycle_segments: ti.template(), 
+                           cycle_length: int, 
+                           partner_edges: ti.template(), 
+                           live_edges: ti.template(), 
+                           live_edges_count: int)\
+                           -> int: 
    
    
     '''
-    For a given edge of the graph, calculate all the patching energies between this edge 
-    and edges not belonging to the same cycle. 
+    For every edge not belonging to a given cycle, calculate the minimal patching energy 
+    between this edge and all the edges of the cycle, in a single launch. Each thread 
+    handles one candidate edge and loops over the cycle, whose edges are stored 
+    contiguously in cycle_edges. Only the edges listed in live_edges are visited. 
+    The energies are not stored: the edge with the minimal energy is found in the 
+    same launch, by an atomic minimum of the energies packed with the edge indexes. 
 
     Parameters 
     -------
@@ -117,64 +328,110 @@ def compute_all_energies(points: ti.template(),
         Fields containing the index of the cycle to which each edge belongs, 
         arranged according to the edges of the grid. 
 
-    energies : ti.template
+    cycle_parent : ti.template
 
-        Fields containing the value of the patching energy with the reference edge, 
-        arranged according to the edges of the grid. 
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
 
-    current_edge_1d_index : int
+    cycle_edges : ti.template
 
-        1D index of the reference edge which will be used to calcultate the energies. 
+        1D field whose first cycle_length values are the 1D indexes 
+        of the edges of the cycle, in the order of the cycle. 
+
+    cycle_segments : ti.template
+
+        1D Vector field whose first cycle_length values are the coordinates of 
+        the two points of each edge of the cycle, see gather_cycle_edges. 
+
+    cycle_length : int
+
+        number of edges in the cycle. 
+
+    partner_edges : ti.template
+
+        Fields containing the 1D index of the edge of the cycle reaching the minimal 
+        patching energy with each edge, arranged according to the edges of the grid. 
+
+    live_edges : ti.template
+
+        1D field whose first live_edges_count values are the 1D indexes 
+        of the edges holding a point, see compact_live_edges. 
+
+    live_edges_count : int
+
+        number of edges holding a point. 
 
         
     Returns
     -------
 
-    None
+    int
+
+        1D index of the edge with the minimal energy, the smallest one in 
+        case of equality, 0 if no edge belongs to another cycle. 
     '''
 
-    edge_I = ti.math.ivec2(current_edge_1d_index, 
-                           next_edge[current_edge_1d_index])
-    edge_cycle = cycle_index[current_edge_1d_index]
+    reference_cycle = find_cycle_root(cycle_parent, 
+                                      cycle_index[cycle_edges[0]])
+
+    #packed (energy, edge), see pack_energy_and_index
+    no_candidate = ~ti.u64(0)
+    minimal_packed_energy = no_candidate
 
+    #one thread per candidate edge, 128 threads per block on GPU
+    ti.loop_config(block_dim=128)
+    for live_index in range(live_edges_count): 
 
-    for index in range(energies.shape[0]): 
+        index = live_edges[live_index]
         
-        #if there is a point thesame cycle
-        if cycle_index[index] == edge_cycle:  
-            energies[index] = ti.math.inf
+        #if there is a point belonging to another cycle, the edges of the same cycle are skipped
+        if find_cycle_root(cycle_parent, cycle_index[index]) != reference_cycle:  
 
-        #if there is no point
-        elif cycle_index[index] == -1: 
-            energies[index] = ti.math.inf
+            #the candidate edge does not change in the loop
+            j_1 = points[index]
+            j_2 = points[next_edge[index]]
+            length_J = euclidean_norm(j_2 - j_1)
 
-        #if there is a point belonging to another cycle
-        elif cycle_index[index] != edge_cycle: 
+            minimal_energy = ti.math.inf
+            partner_edge = cycle_edges[0]
 
+            for position in range(cycle_length): 
 
-            energy = 0. 
-            edge_J = ti.math.ivec2(index, next_edge[index])
-            i_1 = points[edge_I.x]
-            i_2 = points[edge_I.y]
-            j_1 = points[edge_J.x]
-            j_2 = points[edge_J.y]
+                #contiguous reads instead of a gather through next_edge
+                segment_I = cycle_segments[position]
+                i_1 = ti.math.vec2(segment_I[0], segment_I[1])
+                i_2 = ti.math.vec2(segment_I[2], segment_I[3])
+
+                cross = sum_of_euclidean_norms(i_1 - j_2, i_2 - j_1) 
+                no_cross = sum_of_euclidean_norms(i_1 - j_1, i_2 - j_2)
+
+                #branchless choice of the cheapest way to stitch the edges
+                energy = ti.min(cross, no_cross) - euclidean_norm(i_1 - i_2) - length_J
+
+                if energy < minimal_energy: 
+                    minimal_energy = energy
+                    partner_edge = cycle_edges[position]
 
-            cross = euclidean_norm(i_1 - j_2) + euclidean_norm(i_2 - j_1) 
-            no_cross = euclidean_norm(i_1 - j_1) + euclidean_norm(i_2 - j_2)
+            partner_edges[index] = partner_edge
+            ti.atomic_min(minimal_packed_energy, 
+                          pack_energy_and_index(minimal_energy, 
+                                                index))
 
-            if cross < no_cross: 
-                energy = cross - euclidean_norm(i_1 - i_2) - euclidean_norm(j_2 - j_1)
-            else: 
-                energy = no_cross - euclidean_norm(i_1 - i_2) - euclidean_norm(j_2 - j_1)
+    minimal_energy_edge = 0
+    if minimal_packed_energy != no_candidate: 
+        minimal_energy_edge = unpack_index(minimal_packed_energy)
 
-            energies[index] = energy 
+    return minimal_energy_edge
 
 @ti.func
 def compute_neighbours_energies(points: ti.template(), 
                                 next_edge: ti.template(), 
                                 cycle_index: ti.template(),
+                                cycle_parent: ti.template(), 
                                 shape: ti.math.ivec2, 
-                                current_edge_1d_index: int)\
+                                current_edge_1d_index: int, 
+                                current_segment: ti.math.vec4, 
+                                current_cycle: int)\
                                 -> ti.math.vec2: 
     '''
     For a given edge of the graph, calculate all the patching energies between this edge 
@@ -198,6 +455,11 @@ def compute_neighbours_energies(points: ti.template(),
         Fields containing the index of the cycle to which each edge belongs, 
         arranged according to the edges of the grid. 
 
+    cycle_parent : ti.template
+
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
+
     shape : ti.math.ivec2
 
         the dimensions of the scalar field grid. 
@@ -206,6 +468,16 @@ def compute_neighbours_energies(points: ti.template(),
 
         1D index of the reference edge which will be used to calcultate the energies. 
 
+    current_segment : ti.math.vec4
+
+        coordinates of the point of the reference edge, then of the point of 
+        its next edge, see gather_cycle_edges. 
+
+    current_cycle : int
+
+        cycle holding the reference edge, as given by find_cycle_root. It is the 
+        same for all the edges of a cycle, so the caller computes it once. 
+
         
     Returns
     -------
@@ -217,57 +489,66 @@ def compute_neighbours_energies(points: ti.template(),
     '''
     
     #I use 3D edge index instead of 1D edge index
-    edge_I = ti.math.ivec2(current_edge_1d_index, 
-                           next_edge[current_edge_1d_index])
-    edge_I_cycle = cycle_index[current_edge_1d_index]
+    edge_I_cycle = current_cycle
     edge_I_3d_index = edge_1d_to_3d_index(shape, 
                                           current_edge_1d_index)
 
+    #the reference edge does not change in the loop
+    i_1 = ti.math.vec2(current_segment[0], current_segment[1])
+    i_2 = ti.math.vec2(current_segment[2], current_segment[3])
+    length_I = euclidean_norm(i_1 - i_2)
+
+    #packed (energy, position in the window), see pack_energy_and_index
+    no_candidate = ~ti.u64(0)
+    minimal_packed_energy = no_candidate
+
+    #single flattened loop over the 5x5x2 window. It is nested in the loop 
+    #of the caller, so it is never parallelized: the running minimum is safe. 
+    for x_offset, y_offset, z_index in ti.ndrange((-2, 3), (-2, 3), (0, 2)): 
+
+        edge_J_1d_index = edge_3d_to_1d_index(shape, 
+                                              edge_I_3d_index.x + x_offset, 
+                                              edge_I_3d_index.y + y_offset, 
+                                              z_index)
+        #the root lookup is the only call site of find_cycle_root in the loop, 
+        #the cycle is -1 if the edge is outside the grid or holds no point
+        edge_J_cycle = -1
+        if edge_J_1d_index != -1: 
+            edge_J_cycle = find_cycle_root(cycle_parent, 
+                                           cycle_index[edge_J_1d_index])
+
+        #if the edge is outside the grid, or there is no point or a point in the same cycle 
+        if (edge_J_cycle == -1) or (edge_J_cycle == edge_I_cycle): 
+            pass
+        
+        #if there is a point in another cycle 
+        else: 
+
+            edge_J = ti.math.ivec2(edge_J_1d_index, next_edge[edge_J_1d_index])
+            j_1 = points[edge_J.x]
+            j_2 = points[edge_J.y]
+
+            cross = sum_of_euclidean_norms(i_1 - j_2, i_2 - j_1) 
+            no_cross = sum_of_euclidean_norms(i_1 - j_1, i_2 - j_2)
+
+            #branchless choice of the cheapest way to stitch the edges
+            energy = ti.min(cross, no_cross) - length_I - euclidean_norm(j_2 - j_1)
+
+            #positions follow the loop order, ties keep the first edge found
+            window_position = ((x_offset + 2) * 5 + y_offset + 2) * 2 + z_index
+            minimal_packed_energy = ti.min(minimal_packed_energy, 
+                                           pack_energy_and_index(energy, 
+                                                                 window_position))
+
     minimal_energy = ti.math.inf
     minimum_value_3d_index = ti.math.ivec3(0, 0, 0)
 
-    ti.loop_config(serialize= True)
-    for x_index in range(5): 
-        ti.loop_config(serialize= True)
-        for y_index in range(5): 
-            ti.loop_config(serialize= True)
-            for z_index in range(2): 
-
-                edge_J_1d_index = edge_3d_to_1d_index(shape, 
-                                                      edge_I_3d_index.x + x_index- 2, 
-                                                      edge_I_3d_index.y + y_index - 2, 
-                                                      z_index)
-                #if there is a point in the same cycle or no point at all 
-                if (cycle_index[edge_J_1d_index] == edge_I_cycle)\
-                  or (cycle_index[edge_J_1d_index] == -1):  
-                    pass
-                
-                #if there is a point in another cycle 
-                else: 
-
-                    energy = 0.
-                    edge_J = ti.math.ivec2(edge_J_1d_index, next_edge[edge_J_1d_index])
-                    i_1 = points[edge_I.x]
-                    i_2 = points[edge_I.y]
-                    j_1 = points[edge_J.x]
-                    j_2 = points[edge_J.y]
-
-                    cross = euclidean_norm(i_1 - j_2) + euclidean_norm(i_2 - j_1) 
-                    no_cross = euclidean_norm(i_1 - j_1) + euclidean_norm(i_2 - j_2)
-
-                    if cross < no_cross: 
-                        energy = cross - euclidean_norm(i_1 - i_2)\
-                          - euclidean_norm(j_2 - j_1)
-                    else: 
-                        energy = no_cross - euclidean_norm(i_1 - i_2)\
-                          - euclidean_norm(j_2 - j_1)
-
-                    if energy < minimal_energy and energy != ti.math.inf: 
-                        minimal_energy = energy
-                        minimum_value_3d_index = ti.math.ivec3(x_index, 
-                                                               y_index, 
-                                                               z_index)
-
+    if minimal_packed_energy != no_candidate: 
+        minimal_energy = unpack_energy(minimal_packed_energy)
+        window_position = unpack_index(minimal_packed_energy)
+        minimum_value_3d_index = ti.math.ivec3(window_position // 10, 
+                                               (window_position // 2) % 5, 
+                                               window_position % 2)
 
     res = ti.math.vec3(edge_I_3d_index.x + minimum_value_3d_index.x -2, 
                        edge_I_3d_index.y + minimum_value_3d_index.y -2, 
@@ -0,0 +1,46 @@
+import argparse
+
+
+
+def make_parser(second_name: str, 
+                second_help: str, 
+                second_choices: tuple)\
+                -> argparse.ArgumentParser: 
+    '''
+    Create the command line parser shared by the tools which read the 
+    results of the main tool: the name of the scalar field file, then 
+    what to do with it. 
+
+    Parameters 
+    -------
+
+    second_name: str 
+
+        name of the second positional argument. 
+
+    second_help: str 
+
+        help message of the second positional argument. 
+
+    second_choices: tuple 
+
+        values accepted for the second positional argument, any other 
+        value is rejected with an error message when parsing. 
+
+
+    Returns
+    -------
+
+    argparse.ArgumentParser
+
+        parser of the two positional arguments, more arguments can be added. 
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_filename", 
+                        help= "File in .npy format containing the scalar field to be displayed. ", 
+                        type = str) 
+    parser.add_argument(second_name, 
+                        help = second_help, 
+                        choices = second_choices)
+
+    return parser
@@ -2,207 +2,245 @@ import taichi as ti
 
 
 
-ti.init(arch = ti.cpu)
-
-
-
-@ti.func
-def reset_energies(energies: ti.template()): 
+@ti.kernel
+def compact_live_edges(cycle_index: ti.template(), 
+                       live_edges: ti.template())\
+                       -> int: 
     '''
-    Resets the value of the entire field to Nan. 
+    Write the 1D index of every edge holding a point, i.e. belonging to 
+    a cycle, at the beginning of live_edges. The order of the indexes 
+    is not specified. 
 
     Parameters 
     -------
 
-    energies : ti.template
+    cycle_index : ti.template
+
+        Fields containing the index of the cycle to which each edge belongs, 
+        arranged according to 1D indexes of the grid edges. 
+
+    live_edges : ti.template
+
+        1D field of the same size than cycle_index. 
 
-        Fields containing the value of the patching energy with the reference edge, 
-        arranged according to the edges of the grid. 
 
-        
     Returns
     -------
 
-    None
+    int
+
+        number of edges holding a point
     '''
+    live_edges_count = 0
+
+    for index in cycle_index: 
+        if cycle_index[index] != -1: 
+            live_edges[ti.atomic_add(live_edges_count, 1)] = index
 
-    for index in range(energies.shape[0]): 
-        energies[index] = ti.math.inf
+    return live_edges_count
 
 @ti.func
-def find_minimum_in_field(f: ti.template())\
-                            -> ti.math.vec2: 
+def paint_margin(pixels: ti.template(), 
+                 grid: ti.template(), 
+                 colour: ti.math.vec3): 
     '''
-    Find the minimum value and the position of this minimum in a field. 
+    Paint the pixels which are not covered by the grid, i.e. the bottom 
+    and right margins of the square window when the grid is not square. 
+    The pixels covered by the grid are not touched. 
 
     Parameters 
     -------
 
-    f : ti.template
+    pixels : ti.template
+
+        2D square field displayed in a window. 
+
+    grid : ti.template 
+        
+        the 2D field containing the scalar field values. 
+
+    colour : ti.math.vec3 
 
-        1D field for which we want to know the minimum
+        RGB coding of the margin colour. 
 
         
     Returns
     -------
 
-    ti.math.vec2
-
-        x: minimum of the field 
-        y: index of the minimum 
+    None
     '''
-    minimal_value = ti.math.inf
-    index = 0
-        
-           
-    ti.loop_config(serialize=True)
-    for i in range(f.shape[0]):
-        if f[i] < minimal_value and f[i] != ti.math.inf: 
-            minimal_value = f[i]
-            index = i
+    for x_index, y_index in ti.ndrange((grid.shape[0], pixels.shape[0]), 
+                                       (0, pixels.shape[1])): 
+        pixels[x_index, y_index] = encode_colour(pixels, 
+                                                 colour)
 
-    return ti.math.vec2(minimal_value, index)
+    for x_index, y_index in ti.ndrange((0, grid.shape[0]), 
+                                       (grid.shape[1], pixels.shape[1])): 
+        pixels[x_index, y_index] = encode_colour(pixels, 
+                                                 colour)
 
-@ti.kernel
-def count_cycles(cycles: ti.template())\
-                 -> int: 
+@ti.func
+def encode_colour(pixels: ti.template(), 
+                  colour: ti.math.vec3): 
     '''
-    Count the numbers of elements (cycles) in the 'cycles' field, 
-    used for the graph data. 
+    Convert a colour to the dtype of pixels. The canvas converts the 
+    images to 8 bits per channel, so a ti.u8 field loses nothing and 
+    is four times smaller than a float one. 
 
     Parameters 
     -------
 
-    cycles : ti.template
+    pixels : ti.template
+
+        2D square field displayed in a window, of dtype float or ti.u8. 
+
+    colour : ti.math.vec3 
 
-        1D Vector field for which we want to the number of cycles 
-        which size is different from 0
+        RGB coding of the colour, between 0 and 1. 
 
         
     Returns
     -------
 
-    int
+    ti.math.vec3 or ti.math.vec3 of ti.u8
 
-        number of cycles
+        the colour as stored in pixels 
     '''
-    cycles_count = 0
+    if ti.static(pixels.dtype == ti.u8): 
+        return ti.cast(ti.round(ti.math.clamp(colour, 0., 1.) * 255.), ti.u8)
+    else: 
+        return colour
 
-    for index in cycles: 
-        if cycles[index].y != 0: 
-            cycles_count += 1 
-    
-    return cycles_count
-    
-@ti.kernel 
-def fill_final_cycles(cycles: ti.template(), 
-                      final_cycles: ti.template()): 
+@ti.kernel
+def normalize_and_paint(pixels: ti.template(), 
+                        grid: ti.template(), 
+                        lut: ti.template()): 
     '''
-    Fill the field final_cycles with the data of cycles
+    Fill the field pixels with the colours of the grid values brought 
+    between 0 and 1, in a single pass over the grid, in order to be able 
+    to display the grid, which can be in a non-square field. The grid 
+    itself is left unchanged. 
 
     Parameters 
     -------
 
-    cycles : ti.template
+    pixels : ti.template
 
-        1D Vector field with useless [0, 0] vectors. 
+        2D square field displayed in a window. 
 
-    final_cycles : ti.template 
+    grid : ti.template 
         
-        1D Vector field without useless vectors. 
+        the 2D field containing the scalar field values. 
+
+    lut : ti.template 
 
+        1D Vector field containing the viridis colour map, 
+        see build_viridis_lut. 
 
+        
     Returns
     -------
 
     None
     '''
-    for index in final_cycles: 
-        final_cycles[index] = cycles[index]
+    #the last sample of the table is viridis(1.)
+    paint_margin(pixels, 
+                 grid, 
+                 lut[lut.shape[0] - 1])
+    for x_index, y_index in grid: 
+        normalized_value = grid[x_index, y_index] / 2 + 0.5
+        pixels[x_index, y_index] = encode_colour(pixels, 
+                                                 viridis_from_lut(lut, 
+                                                                  normalized_value))
 
 @ti.kernel
-def compute_pixels(pixels: ti.template(), 
-                   grid: ti.template()): 
+def fill_viridis_lut(lut: ti.template()): 
     '''
-    Fill the field pixels with the data of grid, in order to be able 
-    to display the grid,  which can be in a non-square field. 
+    Sample the viridis polynomial at regularly spaced values 
+    between 0 and 1. 
 
     Parameters 
     -------
 
-    pixels : ti.template
+    lut : ti.template 
 
-        2D square field displayed in a window. 
+        1D Vector field receiving the RGB coding of the samples. 
 
-    grid : ti.template 
-        
-        the 2D field containing the scalar field values. 
 
-        
     Returns
     -------
 
     None
     '''
-    pixels.fill(viridis(1.))
-    for x_index, y_index in grid: 
-        pixels[x_index, y_index] = viridis(grid[x_index, y_index])
+    for index in lut: 
+        lut[index] = viridis(index / (lut.shape[0] - 1))
 
-@ti.kernel 
-def normalize_grid(grid: ti.template()): 
+def build_viridis_lut(size: int = 1024)\
+                      -> ti.template(): 
     '''
-    Transforms the field values so that they are between 0 and 1. 
+    Create the lookup table used by viridis_from_lut. 
 
     Parameters 
     -------
 
-    grid : ti.template 
-        
-        the 2D field containing the scalar field values. 
+    size: int 
+
+        number of samples of the colour map, at least 2. 
+
 
-        
     Returns
     -------
 
-    None
-    '''
-    for x_index, y_index in grid: 
-        key = grid[x_index, y_index]
-        grid[x_index, y_index] = key / 2 + 0.5
-
-@ti.kernel
-def shift_lines(grid: ti.template(), 
-                lines: ti.template()): 
+    ti.template
 
+        1D Vector field containing the RGB coding of the samples. 
+    '''
+    lut = ti.Vector.field(n = 3, 
+                          dtype = float, 
+                          shape = size)
+    fill_viridis_lut(lut)
+    return lut
 
+@ti.func
+def viridis_from_lut(lut: ti.template(), 
+                     t: float) -> ti.math.vec3: 
     '''
-    Shift all the lines of half a cell. The scalar field display is 
-    offset from the window, so the lines must also be offset. 
+    Same as viridis, but the colour is linearly interpolated between 
+    the two closest samples of the lookup table instead of evaluating 
+    the polynomial. Values outside [0, 1] still use the polynomial. 
 
     Parameters 
     -------
 
-    grid : ti.template 
-        
-        the 2D field containing the scalar field values. 
+    lut : ti.template 
+
+        1D Vector field built by build_viridis_lut. 
+
+    t: float 
+
+        the number which we want the RGB coding.
 
-    lines : ti.template 
-        
-        1D Vector field containing the coordinates of the points 
-        forming the polylines. 
 
     Returns
     -------
 
-    None
+    ti.math.vec3
+
+        RGB coding
     '''
-    shift = float(1/(2*ti.math.max(grid.shape[0], grid.shape[1])))
+    colour = ti.math.vec3(0., 0., 0.)
+
+    if t >= 0. and t <= 1.: 
+        position = t * (lut.shape[0] - 1)
+        index = ti.min(ti.cast(position, int), lut.shape[0] - 2)
+        colour = ti.math.mix(lut[index], 
+                             lut[index + 1], 
+                             position - index)
+    else: 
+        colour = viridis(t)
+
+    return colour
 
-    for x_index in lines: 
-        key = lines[x_index] 
-        lines[x_index] = ti.math.vec2(key.x + shift, 
-                                      key.y + shift)
-    
 @ti.func
 def viridis(t: float) -> ti.math.vec3:
     '''
@@ -233,4 +271,5 @@ def viridis(t: float) -> ti.math.vec3:
     c5 = ti.math.vec3(4.776384997670288, -13.74514537774601, -65.35303263337234)
     c6 = ti.math.vec3(-5.435455855934631, 4.645852612178535, 26.3124352495832)
     
+    #Horner scheme: one multiply-add per coefficient, fused when fast_math is on
     return c0 + t * (c1 + t * (c2 + t * (c3 + t * (c4 + t * (c5 + t * c6)))))
\ No newline at end of file
@@ -1,33 +1,67 @@
 import taichi as ti 
 
 from cglib.index import index2d_to_edge_index
-from cglib.calc import linear_interpolation
-from cglib.fields import count_cycles, fill_final_cycles
-
-
-
-ti.init(arch = ti.cpu)
-
-
-
-@ti.kernel 
-def compute_binary_grid(grid: ti.template(), 
-                        binary_grid: ti.template()): 
+from cglib.calc import linear_interpolation_of_values, sign_bit
+
+
+
+#marching squares segments of each cell configuration, as (entry edge, exit edge) 
+#pairs, the edges being numbered as in index2d_to_edge_index. The interior is 
+#always on the left. Rows 16 and 17 are the other way of linking the edges 
+#of the saddle configurations 5 and 10. 
+CELL_SEGMENTS = ((), 
+                 ((0, 3),), 
+                 ((1, 0),), 
+                 ((1, 3),), 
+                 ((2, 1),), 
+                 ((0, 1), (2, 3)), 
+                 ((2, 0),), 
+                 ((2, 3),), 
+                 ((3, 2),), 
+                 ((0, 2),), 
+                 ((1, 0), (3, 2)), 
+                 ((1, 2),), 
+                 ((3, 1),), 
+                 ((0, 1),), 
+                 ((3, 0),), 
+                 (), 
+                 ((0, 3), (2, 1)), 
+                 ((3, 0), (1, 2)))
+
+#segments encoded as 4 * entry edge + exit edge, -1 if there is no segment
+FIRST_SEGMENT_LUT = [4 * segments[0][0] + segments[0][1] if len(segments) > 0 else -1 
+                     for segments in CELL_SEGMENTS]
+SECOND_SEGMENT_LUT = [4 * segments[1][0] + segments[1][1] if len(segments) > 1 else -1 
+                      for segments in CELL_SEGMENTS]
+
+#edge of the cell (numbered as in index2d_to_edge_index) from which a cycle is 
+#flooded for each configuration, -1 if no cycle is flooded from this cell: 
+#no edge in the cell, or two edges which may belong to different cycles. 
+FIRST_EDGE_LUT = [-1, 0, 0, 1, 1, -1, 0, 2, 2, 0, -1, 1, 1, 0, 0, -1]
+
+
+
+def init_backend(arch: str = 'cpu', 
+                 **options): 
     '''
-    Gives a 1 to the binary grid if the value of the field with the same coordinates 
-    is positive, 0 if the value of the field is negative. 
+    Initialise the Taichi runtime on the chosen backend. The modules of 
+    cglib do not call ti.init, so the calling code can select the backend 
+    before any kernel is compiled. to_graph calls this function with the 
+    default backend if Taichi has not been initialised yet. 
 
     Parameters 
     -------
 
-    grid: ti.template 
+    arch: str 
 
-        the 2D field containing the scalar field values. 
-        
-    binary_grid : ti.template 
+        name of the Taichi backend: cpu, gpu or cuda. The stitching 
+        reduces packed 64-bit integers with atomic_min, which Metal and 
+        many Vulkan devices do not support, so gpu selects CUDA. 
+        Taichi falls back to the CPU when CUDA is not available. 
 
-        2D field of the same size than grid, 
-        containing the sine of the scalar field in each cell. 
+    options
+
+        other keyword arguments given to ti.init, e.g. offline_cache. 
 
 
     Returns
@@ -35,24 +69,38 @@ def compute_binary_grid(grid: ti.template(),
 
     None
     '''
-    for x_index, y_index in grid:
+    if arch == 'gpu': 
+        arch = 'cuda'
+    ti.init(arch = getattr(ti, arch), 
+            **options)
 
-        sign = ti.math.sign(grid[x_index, y_index])
+def sparse_fields_supported()\
+                            -> bool: 
+    '''
+    Check if the backend Taichi runs on supports sparse SNodes, 
+    which is only the case of the CPU and CUDA backends. 
 
-        #1 if positive, 0 if negative. If the value is equal to zero, the binary grd take the value 1. 
-        if sign == -1: 
-            binary_grid[x_index, y_index] = 0
-        elif sign == 0: 
-            binary_grid[x_index, y_index] = 1 
-        else:  
-            binary_grid[x_index, y_index] = 1
+    Returns
+    -------
+
+    bool
+
+        True if pointer SNodes can be used 
+    '''
+    return ti.lang.impl.current_cfg().arch in (ti.x64, ti.arm64, ti.cuda)
 
 @ti.kernel
-def compute_points(grid: ti.template(), 
-                   binary_grid: ti.template(), 
-                   points: ti.template()): 
+def build_graph_pass(grid: ti.template(), 
+                     cfg_grid: ti.template(), 
+                     points: ti.template(), 
+                     previous_edge: ti.template(),
+                     next_edge: ti.template()): 
     '''
-    Compute the position of all points in the graph. 
+    Compute in a single pass over the grid the configuration of each cell, the position of all points in the graph and their adjacency 
+    (previous point and next point in the cycle). The interior, i.e. where 
+    the field is negative, should always be to the left of the edges. 
+    See marching square algorithm to understand the way the configuration 
+    of a cell is defined. 
 
     Parameters 
     -------
@@ -60,71 +108,195 @@ def compute_points(grid: ti.template(),
     grid: ti.template 
 
         the 2D field containing the scalar field values. 
-        
-    binary_grid : ti.template 
 
-        2D field of the same size than grid, 
-        containing the sine of the scalar field in each cell. 
+    cfg_grid : ti.template
+
+        2D field with one value less than grid in each dimension, 
+        receiving the marching squares configuration of each cell. 
 
     points: ti.template
 
         field containing the coordinates of all the points in the graph, 
         arranged according to 1D indexes of the grid edges. 
 
-        
+    previous_edge: ti.template
+
+        field containing the previous edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+
+    next_edge : ti.template
+    
+        field containing the next edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+
+
     Returns
     -------
 
     None
     '''
-    grid_shape = ti.math.ivec2(grid.shape[0], grid.shape[1])
+    #the shape of a template field is a constant of the compiled kernel: 
+    #the index arithmetic of the inlined funcs is folded with it
+    grid_shape = ti.math.ivec2(ti.static(grid.shape[0]), 
+                               ti.static(grid.shape[1]))
+    first_segments = ti.Vector(FIRST_SEGMENT_LUT, dt = ti.i32)
+    second_segments = ti.Vector(SECOND_SEGMENT_LUT, dt = ti.i32)
+
+    #one thread per row of cells, which walks the row along the contiguous axis
+    for x_index in range(grid_shape.x-1): 
+
+        #the left corners of a cell are the right corners of the previous one
+        left_corners = ti.math.vec2(grid[x_index, 0], 
+                                    grid[x_index+1, 0])
+
+        #the four edge indexes of a cell are those of the previous one plus 1
+        row_edge_indexes = index2d_to_edge_index(ti.math.ivec2(x_index, 0), 
+                                                 grid_shape)
 
-    for x_index, y_index in binary_grid: 
+        for y_index in range(grid_shape.y-1): 
+
+            #the four corners of the cell, in the order of the configuration bits: 
+            #only the two right corners are read
+            values = ti.math.vec4(left_corners.x, 
+                                  grid[x_index, y_index+1], 
+                                  grid[x_index+1, y_index+1], 
+                                  left_corners.y)
+            left_corners = ti.math.vec2(values[1], values[2])
+
+            #the signs of the corners are the bits of the configuration 
+            current_cell_configuration = 0
+            for i in ti.static(range(4)): 
+                current_cell_configuration |= sign_bit(values[i]) << i
+            cfg_grid[x_index, y_index] = current_cell_configuration
+
+            edge_indexes = row_edge_indexes + y_index
+
+            #each cell computes the points of its right and bottom edges, 
+            #the top and left edges belong to the previous cells
+            compute_edge_point(points, 
+                               grid_shape, 
+                               edge_indexes[1], 
+                               ti.math.ivec2(x_index, y_index+1), 
+                               ti.math.ivec2(x_index+1, y_index+1), 
+                               values[1], 
+                               values[2])
+            compute_edge_point(points, 
+                               grid_shape, 
+                               edge_indexes[2], 
+                               ti.math.ivec2(x_index+1, y_index+1), 
+                               ti.math.ivec2(x_index+1, y_index), 
+                               values[2], 
+                               values[3])
+
+            #except on the border of the grid, where there is no previous cell
+            if x_index == 0: 
+                compute_edge_point(points, 
+                                   grid_shape, 
+                                   edge_indexes[0], 
+                                   ti.math.ivec2(x_index, y_index), 
+                                   ti.math.ivec2(x_index, y_index+1), 
+                                   values[0], 
+                                   values[1])
+            if y_index == 0: 
+                compute_edge_point(points, 
+                                   grid_shape, 
+                                   edge_indexes[3], 
+                                   ti.math.ivec2(x_index, y_index), 
+                                   ti.math.ivec2(x_index+1, y_index), 
+                                   values[0], 
+                                   values[3])
+
+            row = current_cell_configuration
+
+            #two edges in the cell, the average value chooses how they are linked
+            if current_cell_configuration == 5 or current_cell_configuration == 10: 
+
+                average_value = (values[0] + values[1] + values[2] + values[3])/4
+
+                if (current_cell_configuration == 5 and average_value <= 0)\
+                    or (current_cell_configuration == 10 and average_value >= 0): 
+                    row = 16 + current_cell_configuration // 10
+
+            #each edge holding a point is entered by the contour in exactly one cell 
+            #and left in exactly one cell: the cells never write to the same entry
+            link_segment(first_segments[row], 
+                         edge_indexes, 
+                         previous_edge, 
+                         next_edge)
+            link_segment(second_segments[row], 
+                         edge_indexes, 
+                         previous_edge, 
+                         next_edge)
 
-        if x_index != grid_shape.x-1 and y_index != grid_shape.y-1: 
-            
-            edge_indexes = index2d_to_edge_index(ti.math.ivec2(x_index, y_index), 
-                                                 grid_shape)
+@ti.func
+def compute_edge_point(points: ti.template(), 
+                       grid_shape: ti.math.ivec2, 
+                       edge: int, 
+                       point_0_index: ti.math.ivec2, 
+                       point_1_index: ti.math.ivec2, 
+                       value_0: float, 
+                       value_1: float): 
+    '''
+    Compute the point of an edge if the scalar field changes sign along it. 
 
+    Parameters 
+    -------
 
-            #arête de droite
-            if binary_grid[x_index, y_index+1] !=  binary_grid[x_index+1, y_index+1]: 
-                right_edge_point = linear_interpolation(grid, 
-                                                        ti.math.ivec2(x_index, y_index+1),
-                                                        ti.math.ivec2(x_index+1 , y_index+1), 
-                                                        0.)
-                points[edge_indexes[1]] = right_edge_point
+    points: ti.template
 
-            #arête du bas 
-            if binary_grid[x_index+1, y_index+1] !=  binary_grid[x_index+1, y_index]: 
-                bottom_edge_point = linear_interpolation(grid, 
-                                                        ti.math.ivec2(x_index+1, y_index+1),
-                                                        ti.math.ivec2(x_index+1, y_index), 
-                                                        0.)
-                points[edge_indexes[2]] = bottom_edge_point
+        field containing the coordinates of all the points in the graph, 
+        arranged according to 1D indexes of the grid edges. 
 
-@ti.kernel
-def compute_adajcency(grid: ti.template(), 
-                      binary_grid: ti.template(), 
-                      previous_edge: ti.template(),
-                      next_edge: ti.template()): 
+    grid_shape: ti.math.ivec2
+
+        2D shape of the scalar field grid
+
+    edge: int 
+
+        1D index of the edge. 
+
+    point_0_index, point_1_index: ti.math.ivec2
+
+        the 2D index of the grid points at both ends of the edge. 
+
+    value_0, value_1: float
+
+        the values of the scalar field at these grid points. 
+
+
+    Returns
+    -------
+
+    None
+    '''
+    if sign_bit(value_0) != sign_bit(value_1): 
+        points[edge] = linear_interpolation_of_values(grid_shape, 
+                                                      point_0_index, 
+                                                      point_1_index, 
+                                                      value_0, 
+                                                      value_1, 
+                                                      0.)
+
+@ti.func
+def link_segment(segment: int, 
+                 edge_indexes: ti.math.ivec4, 
+                 previous_edge: ti.template(),
+                 next_edge: ti.template()): 
     '''
-    Compute the adjacency (previous point and next point in the cycle) 
-    for each point of the graph. The interior, i.e. where the field is negative, 
-    should always be to the left of the edges. See marching square algorithm
-    to understand the way the configuration of a cell is defined. 
+    Link the two edges of a marching squares segment. 
 
     Parameters 
     -------
 
-    grid: ti.template 
+    segment: int 
 
-        the 2D field containing the scalar field values. 
-        
-    binary_grid : ti.template 
+        4 * entry edge + exit edge, the edges being numbered as in 
+        index2d_to_edge_index, or -1 if there is no segment. 
+        See FIRST_SEGMENT_LUT. 
+
+    edge_indexes: ti.math.ivec4
 
-        2D field of the same size than grid, 
-        containing the sine of the scalar field in each cell. 
+        1D indexes of the four edges of the cell. 
 
     previous_edge: ti.template
 
@@ -142,268 +314,259 @@ def compute_adajcency(grid: ti.template(),
 
     None
     '''
-    grid_shape = ti.math.ivec2(binary_grid.shape[0], 
-                               binary_grid.shape[1])
+    if segment != -1: 
+        entry_edge = edge_indexes[segment // 4]
+        exit_edge = edge_indexes[segment % 4]
+        next_edge[entry_edge] = exit_edge
+        previous_edge[exit_edge] = entry_edge
 
-    ti.loop_config(serialize= True)
-    for x_index in range(binary_grid.shape[0]): 
+@ti.kernel
+def init_cycle_labels(next_edge: ti.template(), 
+                      labels: ti.template(), 
+                      jumps: ti.template()): 
+    '''
+    Give each edge its own index as label, and its next edge as jump. 
+    See label_cycles. 
 
-        ti.loop_config(serialize= True)
-        for y_index in range(binary_grid.shape[1]): 
-
-            #border case
-            if x_index != grid_shape.x-1 and y_index != grid_shape.y-1: 
-
-                current_cell = ti.math.ivec2(x_index, y_index)
-                edge_indexes = index2d_to_edge_index(current_cell, 
-                                                     grid_shape)
-                current_cell_configuration =\
-                            1*binary_grid[current_cell[0], current_cell[1]] +\
-                            2*binary_grid[current_cell[0], current_cell[1]+1] +\
-                            4*binary_grid[current_cell[0]+1, current_cell[1]+1] +\
-                            8*binary_grid[current_cell[0]+1, current_cell[1]]
-
-                if current_cell_configuration == 0 or current_cell_configuration == 15: 
-                    for i in range(4): 
-                        next_edge[edge_indexes[i]] = -1
-                        previous_edge[edge_indexes[i]] = -1
-                
-                elif current_cell_configuration == 1: 
-                    next_edge[edge_indexes[0]] = edge_indexes[3]
-                    previous_edge[edge_indexes[3]] = edge_indexes[0]
-
-                            
-                elif current_cell_configuration == 2: 
-                    next_edge[edge_indexes[1]] = edge_indexes[0]
-                    previous_edge[edge_indexes[0]] = edge_indexes[1]
-                    
-                                        
-                elif current_cell_configuration == 3: 
-                    next_edge[edge_indexes[1]] = edge_indexes[3]
-                    previous_edge[edge_indexes[3]] = edge_indexes[1]
-                
-                                        
-                elif current_cell_configuration == 4: 
-                    next_edge[edge_indexes[2]] = edge_indexes[1]
-                    previous_edge[edge_indexes[1]] = edge_indexes[2]
-
-                #two edges in the cell                     
-                elif current_cell_configuration == 5: 
-
-
-                    average_value = (grid[current_cell.x, current_cell.y] +\
-                                        grid[current_cell.x, current_cell.y + 1] +\
-                                        grid[current_cell.x+ 1, current_cell.y+1] +\
-                                        grid[current_cell.x+1, current_cell.y])/4
-                    
-                    if average_value > 0: 
-                        next_edge[edge_indexes[0]] = edge_indexes[1]
-                        previous_edge[edge_indexes[1]] = edge_indexes[0]
-                        
-                        next_edge[edge_indexes[2]] = edge_indexes[3]
-                        previous_edge[edge_indexes[3]] = edge_indexes[2]
-                    else: 
-                        next_edge[edge_indexes[0]] = edge_indexes[3]
-                        previous_edge[edge_indexes[3]] = edge_indexes[0]
-                        
-                        next_edge[edge_indexes[2]] = edge_indexes[1]
-                        previous_edge[edge_indexes[1]] = edge_indexes[2]
-                
-                elif current_cell_configuration == 6: 
-                    next_edge[edge_indexes[2]] = edge_indexes[0]
-                    previous_edge[edge_indexes[0]] = edge_indexes[2]
-
-                elif current_cell_configuration == 7: 
-                    next_edge[edge_indexes[2]] = edge_indexes[3]
-                    previous_edge[edge_indexes[3]] = edge_indexes[2]
-
-                elif current_cell_configuration == 8: 
-                    next_edge[edge_indexes[3]] = edge_indexes[2]
-                    previous_edge[edge_indexes[2]] = edge_indexes[3]
-
-                elif current_cell_configuration == 9: 
-                    next_edge[edge_indexes[0]] = edge_indexes[2]
-                    previous_edge[edge_indexes[2]] = edge_indexes[0]
-
-                #two edges in the cell 
-                elif current_cell_configuration == 10: 
-
-                    average_value = (grid[current_cell.x, current_cell.y] +\
-                                        grid[current_cell.x, current_cell.y + 1] +\
-                                        grid[current_cell.x+ 1, current_cell.y+1] +\
-                                        grid[current_cell.x+1, current_cell.y])/4
-                    
-                    if average_value < 0: 
-                        next_edge[edge_indexes[1]] = edge_indexes[0]
-                        previous_edge[edge_indexes[0]] = edge_indexes[1]
-                        
-                        next_edge[edge_indexes[3]] = edge_indexes[2]
-                        previous_edge[edge_indexes[2]] = edge_indexes[3]
-                    else: 
-                        next_edge[edge_indexes[3]] = edge_indexes[0]
-                        previous_edge[edge_indexes[0]] = edge_indexes[3]
-                        
-                        next_edge[edge_indexes[1]] = edge_indexes[2]
-                        previous_edge[edge_indexes[2]] = edge_indexes[1]       
-
-                elif current_cell_configuration == 11: 
-                    next_edge[edge_indexes[1]] = edge_indexes[2]
-                    previous_edge[edge_indexes[2]] = edge_indexes[1]
-                    
-                elif current_cell_configuration == 12: 
-                    next_edge[edge_indexes[3]] = edge_indexes[1]
-                    previous_edge[edge_indexes[1]] = edge_indexes[3]
-
-                elif current_cell_configuration == 13: 
-                    next_edge[edge_indexes[0]] = edge_indexes[1]
-                    previous_edge[edge_indexes[1]] = edge_indexes[0]
-
-                elif current_cell_configuration == 14: 
-                    next_edge[edge_indexes[3]] = edge_indexes[0]
-                    previous_edge[edge_indexes[0]] = edge_indexes[3]
+    Parameters 
+    -------
+
+    next_edge: ti.template
+
+        field containing the next edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+
+    labels, jumps: ti.template
+
+        fields of the same shape than next_edge. 
+
+        
+    Returns
+    -------
+
+    None
+    '''
+    for edge in next_edge: 
+        labels[edge] = edge
+        jumps[edge] = next_edge[edge]
 
 @ti.kernel
-def browse_grid(grid: ti.template(), 
-                binary_grid: ti.template(), 
-                next_edge: ti.template(), 
-                cycle_index: ti.template(), 
-                cycles: ti.template()): 
+def propagate_cycle_labels(labels: ti.template(), 
+                           jumps: ti.template(), 
+                           new_labels: ti.template(), 
+                           new_jumps: ti.template())\
+                           -> int: 
     '''
-    Browse the entire grid to retrieve information about the graph's cycles. 
+    One pointer jumping step: each edge takes the smallest label between 
+    its own and the one of the edge it jumps to, then jumps twice as far. 
+    The new values are written in separate fields so that every edge 
+    reads the values of the previous step. 
 
     Parameters 
     -------
 
-    grid: ti.template 
+    labels, jumps: ti.template
+
+        labels and jumps of the edges at the previous step. 
+
+    new_labels, new_jumps: ti.template
+
+        labels and jumps of the edges after this step. 
 
-        the 2D field containing the scalar field values. 
         
-    binary_grid : ti.template 
+    Returns
+    -------
 
-        2D field of the same size than grid, 
-        containing the sine of the scalar field in each cell. 
+    int 
+
+        number of labels changed by this step
+    '''
+    changes_count = 0
+
+    for edge in labels: 
+        new_labels[edge] = labels[edge]
+        new_jumps[edge] = jumps[edge]
+
+        #the edge holds a point
+        if jumps[edge] != -1: 
+            label = ti.min(labels[edge], labels[jumps[edge]])
+            if label != labels[edge]: 
+                ti.atomic_add(changes_count, 1)
+            new_labels[edge] = label
+            new_jumps[edge] = jumps[jumps[edge]]
+
+    return changes_count
+
+def label_cycles(next_edge: ti.template())\
+                 -> ti.template(): 
+    '''
+    Label each edge with the smallest 1D index of the edges of its cycle, 
+    by pointer jumping: after k steps, the label of an edge is the smallest 
+    index among the 2^k edges following it, so the number of steps grows 
+    with the logarithm of the length of the longest cycle. Each step is 
+    a parallel pass over the edges. It stops when no label changes anymore, 
+    which only happens once every label is the smallest index of its cycle. 
+
+    Parameters 
+    -------
 
     next_edge: ti.template
 
         field containing the next edge of an edge in a cycle, 
         arranged according to 1D indexes of the grid edges. 
 
-    cycle_index: ti.template
+        
+    Returns
+    -------
 
-        Fields containing the index of the cycle to which each edge belongs, 
+    ti.template
+
+        field containing the label of each edge holding a point, 
         arranged according to 1D indexes of the grid edges. 
+    '''
+    labels = ti.field(dtype = int, 
+                      shape = next_edge.shape)
+    jumps = ti.field(dtype = int, 
+                     shape = next_edge.shape)
+    new_labels = ti.field(dtype = int, 
+                          shape = next_edge.shape)
+    new_jumps = ti.field(dtype = int, 
+                         shape = next_edge.shape)
+    init_cycle_labels(next_edge, 
+                      labels, 
+                      jumps)
+
+    while propagate_cycle_labels(labels, 
+                                 jumps, 
+                                 new_labels, 
+                                 new_jumps) != 0: 
+        labels, new_labels = new_labels, labels
+        jumps, new_jumps = new_jumps, jumps
+
+    return labels
+
+@ti.kernel
+def browse_grid(grid: ti.template(), 
+                cfg_grid: ti.template(), 
+                labels: ti.template(), 
+                cycle_found: ti.template(), 
+                seeds: ti.template())\
+                -> int: 
+    '''
+    Browse the entire grid to find one starting edge per cycle of the graph. 
+    The cycles are numbered in the order in which they are met, and their 
+    starting edge is stored in seeds, the cycles are flooded afterwards. 
+
+    Parameters 
+    -------
+
+    grid: ti.template 
+
+        the 2D field containing the scalar field values. 
+        
+    cfg_grid : ti.template 
+
+        2D field containing the marching squares configuration of each cell, 
+        see build_graph_pass. 
+
+    labels: ti.template
+
+        field containing the label of the cycle of each edge, 
+        see label_cycles. 
+
+    cycle_found: ti.template
+
+        field of the same shape than labels, initialised to 0, 
+        set to 1 for the labels of the cycles already found. 
+
+    seeds: ti.template
+
+        1D field receiving the starting edge of each cycle. 
 
         
     Returns
     -------
 
-    None
+    int
+
+        number of cycles
     '''
 
-    grid_shape = ti.math.ivec2(grid.shape[0], grid.shape[1])
+    #the shape of a template field is a constant of the compiled kernel: 
+    #the index arithmetic of the inlined funcs is folded with it
+    grid_shape = ti.math.ivec2(ti.static(grid.shape[0]), 
+                               ti.static(grid.shape[1]))
+    first_edges = ti.Vector(FIRST_EDGE_LUT, dt = ti.i32)
     cycle_number = 0 
 
     ti.loop_config(serialize= True)
-    for x_index in range(binary_grid.shape[0]): 
+    for x_index in range(cfg_grid.shape[0]): 
 
-        ti.loop_config(serialize= True)
-        for y_index in range(binary_grid.shape[1]): 
-
-            current_cell = ti.math.ivec2(x_index, y_index)
-            current_cell_configuration =\
-                            1*binary_grid[current_cell[0], current_cell[1]] +\
-                            2*binary_grid[current_cell[0], current_cell[1]+1] +\
-                            4*binary_grid[current_cell[0]+1, current_cell[1]+1] +\
-                            8*binary_grid[current_cell[0]+1, current_cell[1]]
-            
-
-            if x_index != grid_shape.x-1 and\
-                y_index != grid_shape.y-1 and \
-                current_cell_configuration > 0 and\
-                current_cell_configuration < 15 and\
-                current_cell_configuration != 5 and\
-                current_cell_configuration != 10 and\
-                is_in_a_cycle(cycle_index, 
-                              ti.math.ivec2(grid.shape[0], grid.shape[1]), 
-                              current_cell) == False: 
-                
-                #we just found a new cycle
-
-                edge_indexes = index2d_to_edge_index(ti.math.ivec2(x_index, y_index),
-                                                     ti.math.ivec2(binary_grid.shape[0],
-                                                     binary_grid.shape[1]))
-                
-                first_edge = edge_indexes[2]
-                if current_cell_configuration == 1\
-                    or current_cell_configuration == 2\
-                    or current_cell_configuration == 6\
-                    or current_cell_configuration == 14\
-                    or current_cell_configuration == 13\
-                    or current_cell_configuration == 9:  
-                
-                    first_edge = edge_indexes[0]
+        #the four edge indexes of a cell are those of the previous one plus 1
+        row_edge_indexes = index2d_to_edge_index(ti.math.ivec2(x_index, 0), 
+                                                 grid_shape)
 
-                elif current_cell_configuration == 3\
-                    or current_cell_configuration == 4\
-                    or current_cell_configuration == 12\
-                    or current_cell_configuration == 11: 
+        ti.loop_config(serialize= True)
+        for y_index in range(cfg_grid.shape[1]): 
 
-                    first_edge = edge_indexes[1]
+            first_edge_position = first_edges[cfg_grid[x_index, y_index]]
 
+            if first_edge_position != -1: 
 
-                flood(next_edge, 
-                      cycle_index, 
-                      cycles, 
-                      first_edge, 
-                      cycle_number)
+                first_edge = row_edge_indexes[first_edge_position] + y_index
                 
-                cycle_number += 1 
+                #we just found a new cycle
+                if cycle_found[labels[first_edge]] == 0: 
+                    cycle_found[labels[first_edge]] = ti.u8(1)
+                    seeds[cycle_number] = first_edge
+                    cycle_number += 1 
 
-@ti.func
-def is_in_a_cycle(cycle_index: ti.template(), 
-                  grid_shape: ti.math.ivec2, 
-                  cell:ti.math.ivec2)\
-                      -> bool: 
+    return cycle_number
+
+@ti.kernel
+def flood_cycles(next_edge: ti.template(), 
+                 cycle_index: ti.template(), 
+                 seeds: ti.template(), 
+                 cycles: ti.template()): 
     '''
-    Check is a cell already has edges belonging to a cycle. 
+    Flood all the cycles found by browse_grid in parallel, one thread 
+    per cycle. The cycles have no edge in common, so the threads never 
+    write to the same entry. 
 
     Parameters 
     -------
 
+    next_edge: ti.template
+
+        field containing the next edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+
     cycle_index: ti.template
 
         Fields containing the index of the cycle to which each edge belongs, 
-        arranged according to 1D indexes of the grid edges.     
-        
-    grid_shape: ti.math.ivec2
+        arranged according to 1D indexes of the grid edges. 
 
-        2D shape of the scalar field grid
+    seeds: ti.template
 
-    cell: ti.math.ivec2
+        1D field containing the starting edge of each cycle, see browse_grid. 
 
-        cell whose edges we want to check in a cycle. 
+    cycles: ti.template
 
+        1D vector fields containing the length and starting edge of each cycle, 
+        with one entry per cycle. 
 
+        
     Returns
     -------
 
-    bool
-
-        True if the cell has one or more edges in a cycle 
-        False if no edge in the cell is in a cycle 
+    None
     '''
-
-    edge_indexes = index2d_to_edge_index(cell, 
-                                         grid_shape)
-    res = False
-
-    ti.loop_config(serialize= True)
-    for i in range(4): 
-
-        if cycle_index[edge_indexes[i]] != -1: 
-            res = True
-
-    return res 
+    for cycle_number in cycles: 
+        flood(next_edge, 
+              cycle_index, 
+              cycles, 
+              seeds[cycle_number], 
+              cycle_number)
 
 @ti.func
 def flood(next_edge: ti.template(), 
@@ -486,57 +649,72 @@ def to_graph(grid: ti.template())\
             - cycle_index 
             - cycles 
     '''
-    # get the binary grid
-    binary_grid = ti.field(dtype = int, shape = grid.shape) 
-    compute_binary_grid(grid, 
-                        binary_grid)
+    #the calling code did not choose a backend 
+    if ti.lang.impl.get_runtime().prog is None: 
+        init_backend()
 
+    cfg_grid = ti.field(dtype = int, 
+                        shape = (grid.shape[0]-1, grid.shape[1]-1))
 
-    # calculate the coordinates of all the points in parallel. 
-    edge_fields_shape = binary_grid.shape[0]*(binary_grid.shape[1]+1)\
-            + binary_grid.shape[1] *(binary_grid.shape[0]+1)\
+    # x and y of the points are stored in two separate arrays (SoA) 
+    # so the energy computations read contiguous components. 
+    edge_fields_shape = grid.shape[0]*(grid.shape[1]+1)\
+            + grid.shape[1] *(grid.shape[0]+1)\
             - 1    
     points = ti.Vector.field(n=2, 
                              dtype=float, 
-                             shape=edge_fields_shape) 
+                             shape=edge_fields_shape, 
+                             layout=ti.Layout.SOA) 
     points.fill(ti.math.nan)
-    compute_points(grid, 
-                   binary_grid, 
-                   points)
-
-
-    # get the adjacency of the graph 
     previous_edge= ti.field(dtype = int, 
                             shape = edge_fields_shape)
     next_edge= ti.field(dtype = int, 
                         shape = edge_fields_shape)
     next_edge.fill(-1)
     previous_edge.fill(-1)
-    compute_adajcency(grid, 
-                      binary_grid, 
-                      previous_edge, 
-                      next_edge)
+
+    # get the points and the adjacency of the graph in a single pass over the grid
+    build_graph_pass(grid, 
+                     cfg_grid, 
+                     points, 
+                     previous_edge, 
+                     next_edge)
     
     
     # get the cycles of the graph
     cycle_index = ti.field(dtype = int, 
                            shape = edge_fields_shape) 
     cycle_index.fill(-1)
+    #sparse storage: a block of the seeds field is only allocated when a seed 
+    #is written in it, the number of cycles is not known yet
+    if sparse_fields_supported(): 
+        seeds = ti.field(dtype = int)
+        seeds_block_size = 256
+        ti.root.pointer(ti.i, (edge_fields_shape + seeds_block_size - 1) // seeds_block_size)\
+               .dense(ti.i, seeds_block_size)\
+               .place(seeds)
+    else: 
+        seeds = ti.field(dtype = int, 
+                         shape = edge_fields_shape)
+
+    # find one starting edge per cycle, then flood the cycles in parallel
+    labels = label_cycles(next_edge)
+    cycle_found = ti.field(dtype = ti.u8, 
+                           shape = edge_fields_shape)
+    cycles_count = browse_grid(grid, 
+                               cfg_grid, 
+                               labels, 
+                               cycle_found, 
+                               seeds)
+    #starting edges and lengths in two separate arrays (SoA), the search 
+    #of the minimal cycle only reads the lengths
     cycles = ti.Vector.field(n = 2, 
                              dtype = int, 
-                             shape = edge_fields_shape)
-    browse_grid(grid, 
-                binary_grid, 
-                next_edge, 
-                cycle_index,
-                cycles)
-
-    # reduce the size of the cycle field 
-    cycles_count = count_cycles(cycles)
-    final_cycles = ti.Vector.field(n = 2, 
-                                   dtype = int, 
-                                   shape = cycles_count) 
-    fill_final_cycles(cycles, 
-                      final_cycles)
-
-    return points, previous_edge, next_edge, cycle_index, final_cycles
\ No newline at end of file
+                             shape = cycles_count, 
+                             layout = ti.Layout.SOA) 
+    flood_cycles(next_edge, 
+                 cycle_index, 
+                 seeds, 
+                 cycles)
+
+    return points, previous_edge, next_edge, cycle_index, cycles
\ No newline at end of file
@@ -2,10 +2,6 @@ import taichi as ti
 
 
 
-ti.init(arch = ti.cpu)
-
-
-
 @ti.func
 def index2d_to_edge_index(cell: ti.math.ivec2, 
                           grid_shape: ti.math.ivec2)\
@@ -92,10 +88,11 @@ def index2d_to_cartesians_coo(grid_shape: ti.math.ivec2,
     cell_count_x = ti.math.max(grid_shape.x, 
                                grid_shape.y)
     
-    x = float(cell.x / cell_count_x)
-    y = float(cell.y / cell_count_x)
+    #a single division, folded when the shape is a constant, 
+    #and one multiplication per coordinate
+    inverse_cell_count = 1. / cell_count_x
     
-    return ti.math.vec2(x, y)
+    return ti.math.vec2(cell.x, cell.y) * inverse_cell_count
 
 @ti.func
 def edge_1d_to_3d_index(shape: ti.math.ivec2, 
@@ -127,23 +124,22 @@ def edge_1d_to_3d_index(shape: ti.math.ivec2,
         3D index of the edge
     '''
 
-    result = ti.math.ivec3(0, 0, 0)
-
     maximal_horizontal_index = shape.y * (shape.x + 1) 
 
-    #if the edge is horizontal 
-    if edge < maximal_horizontal_index:  
-        result.z = 0 
-        result.x = edge // shape.y
-        result.y = edge % shape.y
-
-    # if the edge is vertical  
-    else: 
-        result.z = 1
-        result.x = (edge - maximal_horizontal_index) // (shape.y + 1)
-        result.y = (edge - maximal_horizontal_index) % (shape.y + 1)
-
-    return result 
+    #both orientations are computed and one is selected without branching. 
+    #Each one divides by its own row length, which is a constant when the 
+    #shape is, so the divisions become multiplications. 
+    vertical_edge = edge - maximal_horizontal_index
+    horizontal_result = ti.math.ivec3(edge // shape.y, 
+                                      edge % shape.y, 
+                                      0)
+    vertical_result = ti.math.ivec3(vertical_edge // (shape.y + 1), 
+                                    vertical_edge % (shape.y + 1), 
+                                    1)
+
+    return ti.select(edge < maximal_horizontal_index, 
+                     horizontal_result, 
+                     vertical_result)
 
 @ti.func
 def edge_3d_to_1d_index(shape: ti.math.ivec2, 
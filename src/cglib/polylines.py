@@ -1,8 +1,5 @@
 import taichi as ti 
-
-
-
-ti.init(arch = ti.cpu)
+import numpy as np 
 
 
 
@@ -10,10 +7,16 @@ ti.init(arch = ti.cpu)
 def compute_lines(lines: ti.template(), 
                   points: ti.template(), 
                   next_edge: ti.template(), 
-                  cycles: ti.template()): 
+                  cycles: ti.template(), 
+                  line_offsets: ti.template(), 
+                  lines_count: int, 
+                  shift: float): 
     
     '''
-    Compute the polylines described by the graph. 
+    Compute the polylines described by the graph. The cycles are 
+    walked in parallel, each one writing its own range of lines. 
+    The points are shifted while they are written, and the unused 
+    end of lines is set to nan, so that lines is written only once. 
 
     Parameters 
     __________
@@ -37,40 +40,161 @@ def compute_lines(lines: ti.template(),
 
         field containing the data of the polylines
 
+    line_offsets: ti.template
+
+        1D field containing for each cycle the number of lines 
+        of the previous cycles, i.e. the index of its first line. 
+
+    lines_count: int 
+
+        total number of lines, i.e. the sum of the cycle lengths. 
+
+    shift: float 
+
+        offset applied to both coordinates of the points, see graph_to_polylines. 
+
 
     Returns
     _______
 
     None    
     '''
+    offset = ti.math.vec2(shift, shift)
 
-    line_index = 0
-    point_index =  0 
+    for line_index in range(2 * lines_count, lines.shape[0]): 
+        lines[line_index] = ti.math.vec2(ti.math.nan, ti.math.nan)
 
-    ti.loop_config(serialize= True)
+    #one thread per cycle
     for cycle_index in range(cycles.shape[0]): 
 
         cycle = cycles[cycle_index] 
         point_index = cycle.x
+        line_index = 2 * line_offsets[cycle_index]
         
-        ti.loop_config(serialize=True)
         for _ in range(cycle.y): 
 
-            lines[line_index] = points[point_index]
-            lines[line_index +1] = points[next_edge[point_index]]
-            line_index += 2 
+            next_point = next_edge[point_index]
 
+            lines[line_index] = points[point_index] + offset
+            lines[line_index +1] = points[next_point] + offset
+            line_index += 2 
 
-            next_point = next_edge[point_index]
             point_index = next_point
 
+@ti.kernel
+def compute_cycle_order(order: ti.template(), 
+                        next_edge: ti.template(), 
+                        cycles: ti.template(), 
+                        cycle_offsets: ti.template()): 
+    
+    '''
+    Write the edges of each cycle in traversal order, the cycles being 
+    stored one after the other. The cycles are walked in parallel. 
+
+    Parameters 
+    __________
+
+    order: ti.template
+
+        1D field receiving the 1D indexes of the edges. 
+
+    next_edge: ti.template
+
+        field containing the next edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+
+    cycles: ti.template
+
+        1D vector fields containing the length and starting edge of each cycle. 
+        The starting edge is arbitrarily defined. 
+
+    cycle_offsets: ti.template
+
+        1D field containing for each cycle the sum of the lengths 
+        of the previous cycles, i.e. the position of its first edge. 
+
+
+    Returns
+    _______
+
+    None    
+    '''
+
+    #one thread per cycle
+    for cycle_index in range(cycles.shape[0]): 
+
+        cycle = cycles[cycle_index] 
+        edge_index = cycle.x
+        position = cycle_offsets[cycle_index]
+        
+        for _ in range(cycle.y): 
+
+            order[position] = edge_index
+            edge_index = next_edge[edge_index]
+            position += 1
+
+def graph_to_cycle_order(next_edge: ti.template(), 
+                         cycles: ti.template())\
+                         -> (np.ndarray, np.ndarray): 
+
+    '''
+    Returns the edges of the graph in compressed sparse row form: 
+    the edges of cycle c are order[offsets[c]:offsets[c + 1]], 
+    in traversal order. 
+
+    Parameters 
+    __________
+
+    next_edge: ti.template
+
+        field containing the next edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+
+    cycles: ti.template
+
+        1D vector fields containing the length and starting edge of each cycle. 
+        The starting edge is arbitrarily defined. 
+        
+
+    Returns
+    _______
+
+    tuple (np.ndarray)
+
+        - order: 1D indexes of the edges, cycle after cycle 
+        - offsets: position of the first edge of each cycle in order, 
+          followed by the total number of edges 
+    '''
+
+    cycle_lengths = cycles.to_numpy()[:, 1]
+    offsets = np.zeros(cycle_lengths.shape[0] + 1, 
+                       dtype = np.int32)
+    np.cumsum(cycle_lengths, 
+              out = offsets[1:])
+
+    cycle_offsets = ti.field(dtype = int, 
+                             shape = cycles.shape)
+    cycle_offsets.from_numpy(offsets[:-1])
+    #a field cannot be empty
+    order = ti.field(dtype = int, 
+                     shape = max(1, int(offsets[-1])))
+
+    compute_cycle_order(order, 
+                        next_edge, 
+                        cycles, 
+                        cycle_offsets)
+
+    return order.to_numpy()[:offsets[-1]], offsets
+
 def graph_to_polylines(points: ti.template(), 
                        next_edge: ti.template(), 
-                       cycles: ti.template())\
+                       cycles: ti.template(), 
+                       shift: float = 0.)\
                        -> ti.template(): 
 
     '''
     Returns the polylines of a graph in a field that can be used by the Taichi visualisation tool. 
+    All the cycles are in the same field, so they are drawn by a single canvas.lines call. 
 
     Parameters 
     __________
@@ -89,6 +213,12 @@ def graph_to_polylines(points: ti.template(),
 
         1D vector fields containing the length and starting edge of each cycle. 
         The starting edge is arbitrarily defined. 
+
+    shift: float 
+
+        offset applied to both coordinates of the points. The scalar field 
+        display is offset from the window by half a cell, 1 / (2 * max(grid.shape)), 
+        so the lines must also be offset. 
         
 
     Returns
@@ -99,13 +229,25 @@ def graph_to_polylines(points: ti.template(),
         field containing the data of the polylines
     '''
 
+    #exclusive prefix sum of the cycle lengths
+    cycle_lengths = cycles.to_numpy()[:, 1]
+    lines_count = int(cycle_lengths.sum())
+
+    #two points per line, canvas.lines draws the whole field at each frame 
+    #so it does not get a point per edge of the grid
     lines = ti.Vector.field(dtype = float, 
                             n = 2, 
-                            shape = points.shape) 
-    lines.fill(ti.math.nan)
+                            shape = max(2, 2 * lines_count)) 
+    line_offsets = ti.field(dtype = int, 
+                            shape = cycles.shape)
+    line_offsets.from_numpy((np.cumsum(cycle_lengths) - cycle_lengths).astype(np.int32))
+
     compute_lines(lines, 
                   points, 
                   next_edge,
-                  cycles)
+                  cycles, 
+                  line_offsets, 
+                  lines_count, 
+                  shift)
     
     return lines
\ No newline at end of file
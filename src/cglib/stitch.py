@@ -1,25 +1,29 @@
+import heapq
+
 import taichi as ti 
+import numpy as np 
 import tqdm
 
-from cglib.fields import reset_energies, find_minimum_in_field 
-from cglib.calc import compute_all_energies, compute_neighbours_energies
-
-#test
+from cglib.fields import compact_live_edges
+from cglib.calc import compute_cycle_energies, compute_neighbours_energies, find_cycle_root, pack_energy_and_index, unpack_index
+from cglib.calc import euclidean_norm, sum_of_euclidean_norms
 
-ti.init(arch = ti.cpu)
 
 
-
-@ti.func
+@ti.kernel
 def stitch_two_cycles(previous_edge: ti.template(), 
                       next_edge: ti.template(), 
                       cycle_index: ti.template(), 
+                      cycle_parent: ti.template(), 
                       cycles: ti.template(), 
-                      minimal_energy_edges: ti.math.ivec2):
+                      minimal_energy_edges: ti.math.ivec2)\
+                      -> ti.math.ivec2:
     
         
     '''
     Stitch two cycles together, by exchanging the adjacency of two edges.
+    The edges of the second cycle are not relabelled, the second cycle
+    only gets the first one as parent, see find_cycle_root. 
 
     Parameters 
     -------
@@ -39,6 +43,11 @@ def stitch_two_cycles(previous_edge: ti.template(),
         Fields containing the index of the cycle to which each edge belongs, 
         arranged according to 1D indexes of the grid edges.  
 
+    cycle_parent: ti.template
+
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
+
     cycles: ti.template
 
         1D vector fields containing the length and starting edge of each cycle. 
@@ -49,14 +58,142 @@ def stitch_two_cycles(previous_edge: ti.template(),
         vector of 1D index of the two edges whose adjacency must be changed. 
         
 
+    Returns
+    -------
+
+    ti.math.ivec2
+
+        x: index of the cycle which is kept
+        y: index of the cycle which is emptied
+    '''
+    return stitch_edges(previous_edge, 
+                        next_edge, 
+                        cycle_index, 
+                        cycle_parent, 
+                        cycles, 
+                        minimal_energy_edges)
+
+@ti.kernel
+def stitch_cycles_batch(previous_edge: ti.template(), 
+                        next_edge: ti.template(), 
+                        cycle_index: ti.template(), 
+                        cycle_parent: ti.template(), 
+                        cycles: ti.template(), 
+                        batch_edges: ti.template(), 
+                        batch_size: int): 
+    '''
+    Same as stitch_two_cycles for several pairs of edges at once, one 
+    thread per pair. Two pairs must not involve the same cycle, so that 
+    the threads never write the same entries. 
+
+    Parameters 
+    -------
+
+    previous_edge: ti.template
+
+        field containing the previous edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+    
+    next_edge: ti.template
+
+        field containing the next edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+
+    cycle_index: ti.template
+
+        Fields containing the index of the cycle to which each edge belongs, 
+        arranged according to 1D indexes of the grid edges.  
+
+    cycle_parent: ti.template
+
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
+
+    cycles: ti.template
+
+        1D vector fields containing the length and starting edge of each cycle. 
+        The starting edge is arbitrarily defined. 
+
+    batch_edges: ti.template
+
+        1D vector field whose first batch_size values are the pairs of 
+        edges to stitch. 
+
+    batch_size: int 
+
+        number of pairs to stitch. 
+
+
     Returns
     -------
 
     None
     '''
+    for pair_number in range(batch_size): 
+        stitch_edges(previous_edge, 
+                     next_edge, 
+                     cycle_index, 
+                     cycle_parent, 
+                     cycles, 
+                     batch_edges[pair_number])
+
+@ti.func
+def stitch_edges(previous_edge: ti.template(), 
+                 next_edge: ti.template(), 
+                 cycle_index: ti.template(), 
+                 cycle_parent: ti.template(), 
+                 cycles: ti.template(), 
+                 minimal_energy_edges: ti.math.ivec2)\
+                 -> ti.math.ivec2:
+    '''
+    Stitch two cycles together, see stitch_two_cycles. 
+
+    Parameters 
+    -------
+
+    previous_edge: ti.template
+
+        field containing the previous edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+    
+    next_edge: ti.template
+
+        field containing the next edge of an edge in a cycle, 
+        arranged according to 1D indexes of the grid edges. 
+
+    cycle_index: ti.template
+
+        Fields containing the index of the cycle to which each edge belongs, 
+        arranged according to 1D indexes of the grid edges.  
+
+    cycle_parent: ti.template
+
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
+
+    cycles: ti.template
+
+        1D vector fields containing the length and starting edge of each cycle. 
+        The starting edge is arbitrarily defined. 
+
+    minimal_energy_edges: ti.math.ivec2
+
+        vector of 1D index of the two edges whose adjacency must be changed. 
+        
+
+    Returns
+    -------
+
+    ti.math.ivec2
+
+        x: index of the cycle which is kept
+        y: index of the cycle which is emptied
+    '''
 
-    cycle_1_index = cycle_index[minimal_energy_edges.x]
-    cycle_2_index = cycle_index[minimal_energy_edges.y]
+    cycle_1_index = find_cycle_root(cycle_parent, 
+                                    cycle_index[minimal_energy_edges.x])
+    cycle_2_index = find_cycle_root(cycle_parent, 
+                                    cycle_index[minimal_energy_edges.y])
 
     #change next_edge and previous_edge
     edge_I = ti.math.ivec2(minimal_energy_edges.x, 
@@ -71,13 +208,8 @@ def stitch_two_cycles(previous_edge: ti.template(),
     next_edge[edge_J.x] = edge_I.y
     previous_edge[edge_J.y] = edge_I.x 
 
-    #change cycle_index
-    point = next_edge[minimal_energy_edges.x] 
-    while point != minimal_energy_edges.x: 
-        #we keep the first cycle index
-        cycle_index[point] = cycle_1_index 
-        next_point = next_edge[point]
-        point = next_point
+    #we keep the first cycle index
+    cycle_parent[cycle_2_index] = cycle_1_index
 
     #change cycles
     new_cycle = ti.math.ivec2(cycles[cycle_1_index].x, 
@@ -85,11 +217,66 @@ def stitch_two_cycles(previous_edge: ti.template(),
     cycles[cycle_1_index] = new_cycle
     cycles[cycle_2_index] = ti.math.ivec2(0, 0)
 
-@ti.func
-def find_minimal_cycle(cycles: ti.template(), 
-                       nb_cycles: int) -> int: 
+    return ti.math.ivec2(cycle_1_index, 
+                         cycle_2_index)
+
+@ti.kernel
+def init_cycle_parents(cycle_parent: ti.template()):
     '''
-    Find the graph cycle with the fewest points. 
+    Make every cycle its own parent, i.e. no cycle has been stitched yet. 
+
+    Parameters 
+    -------
+
+    cycle_parent: ti.template
+
+        1D field with one entry per cycle. 
+
+
+    Returns
+    -------
+
+    None
+    '''
+    for cycle_number in cycle_parent:
+        cycle_parent[cycle_number] = cycle_number
+
+@ti.kernel
+def resolve_cycle_index(cycle_index: ti.template(), 
+                        cycle_parent: ti.template()):
+    '''
+    Replace the cycle of every edge by the cycle currently holding it, 
+    so that cycle_index is up to date once the stitching is over. 
+
+    Parameters 
+    -------
+
+    cycle_index: ti.template
+
+        Fields containing the index of the cycle to which each edge belongs, 
+        arranged according to 1D indexes of the grid edges. 
+
+    cycle_parent: ti.template
+
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
+
+
+    Returns
+    -------
+
+    None
+    '''
+    for index in cycle_index:
+        cycle_index[index] = find_cycle_root(cycle_parent, 
+                                             cycle_index[index])
+
+def build_cycle_heap(cycles: ti.template()): 
+    '''
+    Build a min-heap of the non-empty cycles keyed by their length. The 
+    heap is updated after each stitch by merge_cycle_lengths, so the 
+    cycles field is only read once instead of being scanned before 
+    every stitch. 
 
     Parameters 
     -------
@@ -98,7 +285,45 @@ def find_minimal_cycle(cycles: ti.template(),
 
         1D vector fields containing the length and starting edge of each cycle. 
         The starting edge is arbitrarily defined. 
-        
+
+
+    Returns
+    -------
+
+    list 
+
+        heap of (length, cycle index) tuples 
+
+    list 
+
+        current length of each cycle, used to detect stale heap entries 
+    '''
+    lengths = cycles.to_numpy()[:, 1].tolist()
+    heap = [(length, cycle_number) for cycle_number, length in enumerate(lengths) 
+            if length != 0]
+    heapq.heapify(heap)
+
+    return heap, lengths
+
+def pop_minimal_cycle(heap: list, 
+                      lengths: list) -> int: 
+    '''
+    Find the non-empty cycle with the fewest points, using the heap 
+    built by build_cycle_heap, the smallest index in case of equality. 
+    Entries whose length is no longer the length of their cycle are 
+    outdated and skipped. 
+
+    Parameters 
+    -------
+
+    heap: list 
+
+        heap of (length, cycle index) tuples. 
+
+    lengths: list 
+
+        current length of each cycle. 
+
 
     Returns
     -------
@@ -107,50 +332,65 @@ def find_minimal_cycle(cycles: ti.template(),
 
         the index of the minimal cycle 
     '''
-    minimal_cycle_index = 0 
-    minimal_cycle_lenght = ti.math.inf
-    cycle_lenght = 0 
+    while True: 
+        length, cycle_number = heapq.heappop(heap)
+        if length == lengths[cycle_number]: 
+            return cycle_number
+
+def merge_cycle_lengths(heap: list, 
+                        lengths: list, 
+                        cycle_1_index: int, 
+                        cycle_2_index: int): 
+    '''
+    Report in the heap the stitch of two cycles done by stitch_two_cycles: 
+    the first cycle receives the points of the second one, which becomes 
+    empty. 
 
-    ti.loop_config(serialize=True)
-    for cycle_number in range(nb_cycles): 
+    Parameters 
+    -------
 
-        cycle = cycles[cycle_number]
-        cycle_lenght = cycle.y
+    heap: list 
 
-        if cycle_lenght < minimal_cycle_lenght\
-              and cycle_lenght != 0: 
-            minimal_cycle_index = cycle_number
-            minimal_cycle_lenght = cycle_lenght
+        heap of (length, cycle index) tuples. 
 
-    return minimal_cycle_index
+    lengths: list 
 
-@ti.func
-def find_edges_with_minimum_energy(points: ti.template(), 
-                                   next_edge: ti.template(),  
-                                   cycle_index: ti.template(), 
-                                   cycles: ti.template(), 
-                                   energies: ti.template(), 
-                                   minimal_cycle_index: int)\
-                                   -> ti.math.ivec2: 
-        
-        
+        current length of each cycle. 
+
+    cycle_1_index: int 
+
+        index of the cycle which is kept. 
+
+    cycle_2_index: int 
+
+        index of the cycle which is emptied. 
+
+
+    Returns
+    -------
+
+    None
     '''
-    Find an edge in the minimal cycle and an edge outside this cycle such 
-    that the patching energy of these two edges is minimal 
-    compared with all the other energies. 
+    lengths[cycle_1_index] += lengths[cycle_2_index]
+    lengths[cycle_2_index] = 0
+    heapq.heappush(heap, 
+                   (lengths[cycle_1_index], cycle_1_index))
+
+def start_stitching(points: ti.template(), 
+                    cycle_index: ti.template(), 
+                    cycles: ti.template()): 
+    '''
+    Allocate the scratch fields shared by the stitching drivers. 
+    Stitching never removes a point, so the live edges are computed 
+    once here, and every cycle starts as its own root. 
 
     Parameters 
     -------
 
-    points : ti.template
+    points: ti.template
 
         field containing the coordinates of all the points in the graph, 
-        arranged according to the edges of the grid. 
-
-    next_edge: ti.template
-
-        field containing the next edge of an edge in a cycle, 
-        arranged according to 1D indexes of the grid edges. 
+        arranged according to the edges of the grid.
 
     cycle_index: ti.template
 
@@ -162,64 +402,72 @@ def find_edges_with_minimum_energy(points: ti.template(),
         1D vector fields containing the length and starting edge of each cycle. 
         The starting edge is arbitrarily defined. 
 
-    minimal_cycle_index : int 
-
-        index of the minimal cycle
-        
 
     Returns
     -------
 
-    ti.math.ivec2: 
+    tuple 
 
-        int vector containing 1D index of the the edges to stitch
+        live_edges, live_edges_count, cycle_edges, cycle_segments, 
+        partner_edges and cycle_parent 
+    '''
+    live_edges = ti.field(dtype = int, 
+                          shape = points.shape)
+    live_edges_count = compact_live_edges(cycle_index, 
+                                          live_edges)
+    cycle_edges = ti.field(dtype = int, 
+                           shape = points.shape)
+    cycle_segments = ti.Vector.field(n = 4, 
+                                     dtype = float, 
+                                     shape = points.shape)
+    partner_edges = ti.field(dtype = int, 
+                             shape = points.shape)
+    cycle_parent = ti.field(dtype = int, 
+                            shape = cycles.shape[0])
+    init_cycle_parents(cycle_parent)
+
+    return live_edges, live_edges_count, cycle_edges, cycle_segments, partner_edges, cycle_parent
+
+def finish_stitching(cycle_index: ti.template(), 
+                     cycle_parent: ti.template()): 
     '''
+    Finish a stitching driver by writing the root of its cycle 
+    into the cycle index of every edge. 
 
-    minimal_cycle = cycles[minimal_cycle_index]
+    Parameters 
+    -------
 
+    cycle_index: ti.template
 
-    start_point_index = minimal_cycle.x
+        Fields containing the index of the cycle to which each edge belongs, 
+        arranged according to 1D indexes of the grid edges.  
 
-    minimal_energy = ti.math.inf
-    minimal_energy_edges = ti.math.ivec2(0, 0)
+    cycle_parent: ti.template
 
-    end_point_index = 0
+        parent of each cycle, filled by the stitching driver 
 
-    ti.loop_config(serialize=True)
-    #cycle.y = lenght of the cycle
-    for _ in range(minimal_cycle.y): 
-        
-        
-        reset_energies(energies)
-        compute_all_energies(points, 
-                             next_edge, 
-                             cycle_index, 
-                             energies, 
-                             start_point_index)
-        min_and_index = find_minimum_in_field(energies)
-        
-        if min_and_index.x < minimal_energy: 
-            minimal_energy = min_and_index.x
-            minimal_energy_edges = ti.math.ivec2(start_point_index, 
-                                                 min_and_index.y)
-
-        end_point_index = next_edge[start_point_index]
-        start_point_index = end_point_index
 
+    Returns
+    -------
 
-    return minimal_energy_edges
+    None    
+    '''
+    resolve_cycle_index(cycle_index, 
+                        cycle_parent)
 
 @ti.kernel
-def compiled_stitching_algorithm(points: ti.template(), 
-                                 previous_edge: ti.template(), 
-                                 next_edge: ti.template(), 
-                                 cycle_index: ti.template(), 
-                                 cycles: ti.template(), 
-                                 energies: ti.template()): 
-
+def gather_cycle_edges(points: ti.template(), 
+                       next_edge: ti.template(), 
+                       cycles: ti.template(), 
+                       cycle_number: int, 
+                       cycle_edges: ti.template(), 
+                       cycle_segments: ti.template()): 
     '''
-    Stitch all the cycles of a graph. This is the compiled function called in an non-compiled
-    one because we need to create the "energies" field. 
+    Store the 1D indexes of the edges of a cycle contiguously, 
+    in the order of the cycle, starting from its starting edge. 
+    The two points of each edge are stored in the same order, so that 
+    the energy searches read them contiguously instead of following 
+    next_edge. 
 
     Parameters 
     -------
@@ -227,13 +475,81 @@ def compiled_stitching_algorithm(points: ti.template(),
     points : ti.template
 
         field containing the coordinates of all the points in the graph, 
-        arranged according to the edges of the grid.
+        arranged according to the edges of the grid. 
 
-    previous_edge: ti.template
+    next_edge: ti.template
 
-        field containing the previous edge of an edge in a cycle, 
+        field containing the next edge of an edge in a cycle, 
         arranged according to 1D indexes of the grid edges. 
 
+    cycles: ti.template
+
+        1D vector fields containing the length and starting edge of each cycle. 
+        The starting edge is arbitrarily defined. 
+
+    cycle_number: int
+
+        index of the cycle to gather. 
+
+    cycle_edges: ti.template
+
+        1D field receiving the edges of the cycle. 
+
+    cycle_segments: ti.template
+
+        1D Vector field of size 4 receiving the coordinates of the point 
+        of each edge of the cycle, then of the point of its next edge. 
+
+
+    Returns
+    -------
+
+    None
+    '''
+    cycle = cycles[cycle_number]
+    current_edge = cycle.x
+
+    ti.loop_config(serialize=True)
+    for position in range(cycle.y): 
+        cycle_edges[position] = current_edge
+        current_edge = next_edge[current_edge]
+
+    for position in range(cycle.y): 
+        edge = cycle_edges[position]
+        start_point = points[edge]
+        end_point = points[next_edge[edge]]
+        cycle_segments[position] = ti.math.vec4(start_point.x, start_point.y, 
+                                                end_point.x, end_point.y)
+
+def find_edges_with_minimum_energy(points: ti.template(), 
+                                   next_edge: ti.template(),  
+                                   cycle_index: ti.template(), 
+                                   cycle_parent: ti.template(), 
+                                   cycles: ti.template(), 
+                                   cycle_edges: ti.template(), 
+                                   cycle_segments: ti.template(), 
+                                   partner_edges: ti.template(), 
+                                   live_edges: ti.template(), 
+                                   live_edges_count: int, 
+                                   minimal_cycle_index: int)\
+                                   -> ti.math.ivec2: 
+        
+        
+    '''
+    Find an edge in the minimal cycle and an edge outside this cycle such 
+    that the patching energy of these two edges is minimal 
+    compared with all the other energies. All the pairs are evaluated 
+    in a single parallel launch of compute_cycle_energies. The edges of 
+    the minimal cycle must already be gathered in cycle_edges. 
+
+    Parameters 
+    -------
+
+    points : ti.template
+
+        field containing the coordinates of all the points in the graph, 
+        arranged according to the edges of the grid. 
+
     next_edge: ti.template
 
         field containing the next edge of an edge in a cycle, 
@@ -244,41 +560,68 @@ def compiled_stitching_algorithm(points: ti.template(),
         Fields containing the index of the cycle to which each edge belongs, 
         arranged according to 1D indexes of the grid edges.  
 
+    cycle_parent: ti.template
+
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
+
     cycles: ti.template
 
         1D vector fields containing the length and starting edge of each cycle. 
         The starting edge is arbitrarily defined. 
 
-    energies : ti.template
+    cycle_edges : ti.template
 
-        Fields containing the value of the patching energy with the reference edge, 
-        arranged according to the edges of the grid. 
+        1D field containing the edges of the minimal cycle in traversal 
+        order, see gather_cycle_edges. 
+
+    cycle_segments : ti.template
+
+        1D Vector field containing the coordinates of the two points of each 
+        edge of the minimal cycle, see gather_cycle_edges. 
+
+    partner_edges : ti.template
+
+        1D scratch field receiving, for each edge, the edge of the minimal 
+        cycle giving its energy. 
+
+    live_edges : ti.template
+
+        1D field whose first live_edges_count values are the 1D indexes 
+        of the edges holding a point. 
+
+    live_edges_count : int
+
+        number of edges holding a point. 
+
+    minimal_cycle_index : int 
+
+        index of the minimal cycle
         
 
     Returns
     -------
 
-    None    
+    ti.math.ivec2: 
+
+        int vector containing 1D index of the the edges to stitch
     '''
-    nb_cycles = cycles.shape[0]
 
-    ti.loop_config(serialize= True)
-    for _ in range(nb_cycles - 1): 
+    #compute_cycle_energies reduces the minimum in the same launch
+    edge_J_1d_index = compute_cycle_energies(points, 
+                                             next_edge, 
+                                             cycle_index, 
+                                             cycle_parent, 
+                                             cycle_edges, 
+                                             cycle_segments, 
+                                             cycles[minimal_cycle_index].y, 
+                                             partner_edges, 
+                                             live_edges, 
+                                             live_edges_count)
+
+    return ti.math.ivec2(partner_edges[edge_J_1d_index], 
+                         edge_J_1d_index)
 
-        minimal_cycle_index = find_minimal_cycle(cycles, 
-                                                 nb_cycles)
-        minimal_energy_edges = find_edges_with_minimum_energy(points, 
-                                                              next_edge, 
-                                                              cycle_index,
-                                                              cycles, 
-                                                              energies, 
-                                                              minimal_cycle_index)
-        stitch_two_cycles(previous_edge, 
-                          next_edge,
-                          cycle_index, 
-                          cycles, 
-                          minimal_energy_edges)
-        
 def stitch_all_cycles(points: ti.template(), 
                       previous_edge: ti.template(), 
                       next_edge: ti.template(), 
@@ -323,14 +666,47 @@ def stitch_all_cycles(points: ti.template(),
     None    
     '''
 
-    energies = ti.field(dtype= float, 
-                        shape = points.shape)
-    compiled_stitching_algorithm(points, 
-                                 previous_edge, 
-                                 next_edge, 
-                                 cycle_index, 
-                                 cycles, 
-                                 energies)
+    live_edges, live_edges_count, cycle_edges, cycle_segments, partner_edges, cycle_parent =\
+        start_stitching(points, 
+                        cycle_index, 
+                        cycles)
+    nb_cycles = cycles.shape[0]
+    heap, lengths = build_cycle_heap(cycles)
+
+    for _ in range(nb_cycles - 1): 
+
+        minimal_cycle_index = pop_minimal_cycle(heap, 
+                                                lengths)
+        gather_cycle_edges(points, 
+                           next_edge, 
+                           cycles, 
+                           minimal_cycle_index, 
+                           cycle_edges, 
+                           cycle_segments)
+        minimal_energy_edges = find_edges_with_minimum_energy(points, 
+                                                              next_edge, 
+                                                              cycle_index, 
+                                                              cycle_parent, 
+                                                              cycles, 
+                                                              cycle_edges, 
+                                                              cycle_segments, 
+                                                              partner_edges, 
+                                                              live_edges, 
+                                                              live_edges_count, 
+                                                              minimal_cycle_index)
+        stitched_cycles = stitch_two_cycles(previous_edge, 
+                                            next_edge, 
+                                            cycle_index, 
+                                            cycle_parent, 
+                                            cycles, 
+                                            minimal_energy_edges)
+        merge_cycle_lengths(heap, 
+                            lengths, 
+                            stitched_cycles.x, 
+                            stitched_cycles.y)
+
+    finish_stitching(cycle_index, 
+                     cycle_parent)
 
 
 '''
@@ -338,20 +714,27 @@ def stitch_all_cycles(points: ti.template(),
 OPTIMISED VERSION
 '''
 
-@ti.func
+@ti.kernel
 def find_edges_with_minimum_energy_with_neighbours(points: ti.template(), 
                                                     next_edge: ti.template(),  
                                                     cycle_index: ti.template(), 
-                                                    cycles: ti.template(), 
-                                                    energies: ti.template(), 
-                                                    minimal_cycle_index: int, 
+                                                    cycle_parent: ti.template(), 
+                                                    cycle_edges: ti.template(), 
+                                                    cycle_segments: ti.template(), 
+                                                    cycle_length: int, 
+                                                    partner_edges: ti.template(), 
                                                     shape: ti.math.ivec2)\
                                                     -> ti.math.ivec2: 
     '''
     Find an edge in the minimal cycle and an edge outside this cycle such 
     that the patching energy of these two edges is minimal 
     compared with all the other energies. This version uses optimisation 
-    and only calculates energy for neighbours. 
+    and only calculates energy for neighbours. The edges of the minimal 
+    cycle are processed in parallel, the minimum being a single atomic 
+    reduction of the energy packed with the position in the cycle. 
+
+    If no edge of another cycle is close to the minimal cycle, 
+    [-1, -1] is returned and the classic method has to be used. 
 
     Parameters 
     ------
@@ -371,18 +754,34 @@ def find_edges_with_minimum_energy_with_neighbours(points: ti.template(),
         Fields containing the index of the cycle to which each edge belongs, 
         arranged according to 1D indexes of the grid edges.  
 
-    cycles: ti.template
+    cycle_parent: ti.template
 
-        1D vector fields containing the length and starting edge of each cycle. 
-        The starting edge is arbitrarily defined. 
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
 
-    minimal_cycle_index : int 
+    cycle_edges : ti.template
 
-        index of the minimal cycle
+        1D field whose first cycle_length values are the 1D indexes 
+        of the edges of the minimal cycle, see gather_cycle_edges. 
+
+    cycle_segments : ti.template
+
+        1D Vector field whose first cycle_length values are the coordinates of 
+        the two points of each edge of the minimal cycle, see gather_cycle_edges. 
+
+    cycle_length : int
+
+        number of edges in the minimal cycle. 
+
+    partner_edges : ti.template
+
+        1D scratch field receiving, for each position in the cycle, 
+        the neighbour edge giving the minimal energy. 
     
     shape: ti.math.ivec2
 
-        shape of the scalar field grid
+        shape of the scalar field grid. It is a runtime argument, so the 
+        kernel is compiled once for all the grid shapes. 
         
 
     Returns
@@ -393,76 +792,124 @@ def find_edges_with_minimum_energy_with_neighbours(points: ti.template(),
         int vector containing 1D index of the the edges to stitch
     '''
 
-    minimal_cycle = cycles[minimal_cycle_index]
-
-
-    current_edge_1d_index = minimal_cycle.x
-
-    minimal_energy = ti.math.inf
-    minimal_energy_edges = ti.math.ivec2(0, 0)
-
-    end_point_index = 0
+    #packed (energy, position in the cycle), see pack_energy_and_index
+    no_candidate = ~ti.u64(0)
+    minimal_packed_energy = no_candidate
 
+    #all the edges of the minimal cycle have the same root
+    minimal_cycle = find_cycle_root(cycle_parent, 
+                                    cycle_index[cycle_edges[0]])
 
-    #only for neighboring edges 
-    ti.loop_config(serialize=True)
-    for _ in range(minimal_cycle.y): 
+    #one thread per edge of the minimal cycle, ties keep the first position 
+    for position in range(cycle_length): 
         
         min_and_index = compute_neighbours_energies(points, 
                                                     next_edge, 
                                                     cycle_index, 
+                                                    cycle_parent, 
                                                     shape, 
-                                                    current_edge_1d_index)
+                                                    cycle_edges[position], 
+                                                    cycle_segments[position], 
+                                                    minimal_cycle)
 
-        if (min_and_index.x < minimal_energy)\
-              and (min_and_index.x != ti.math.inf): 
-            minimal_energy = min_and_index.x
-            minimal_energy_edges = ti.math.ivec2(current_edge_1d_index, 
-                                                 min_and_index.y)
+        if min_and_index.x != ti.math.inf: 
+            partner_edges[position] = int(min_and_index.y)
+            ti.atomic_min(minimal_packed_energy, 
+                          pack_energy_and_index(min_and_index.x, 
+                                                position))
 
+    #if we didn't find neighbours 
+    minimal_energy_edges = ti.math.ivec2(-1, -1)
 
-        end_point_index = next_edge[current_edge_1d_index]
-        current_edge_1d_index = end_point_index
-    
-    #if we didn't find neighbours, use the classic method 
-    if minimal_energy == ti.math.inf: 
-        ti.loop_config(serialize=True)
-        for _ in range(minimal_cycle.y): 
-            
-            reset_energies(energies)
-            compute_all_energies(points, 
-                                 next_edge, 
-                                 cycle_index, 
-                                 energies, 
-                                 current_edge_1d_index)
-            min_and_index = find_minimum_in_field(energies)
-            
-            if min_and_index.x < minimal_energy: 
-                minimal_energy = min_and_index.x
-                minimal_energy_edges = ti.math.ivec2(current_edge_1d_index, 
-                                                     min_and_index.y)
-
-            end_point_index = next_edge[current_edge_1d_index]
-            current_edge_1d_index = end_point_index
+    if minimal_packed_energy != no_candidate: 
+        position = unpack_index(minimal_packed_energy)
+        minimal_energy_edges = ti.math.ivec2(cycle_edges[position], 
+                                             partner_edges[position])
 
     return minimal_energy_edges
 
+def find_stitching_edges(points: ti.template(), 
+                         next_edge: ti.template(), 
+                         cycle_index: ti.template(), 
+                         cycle_parent: ti.template(), 
+                         cycles: ti.template(), 
+                         cycle_edges: ti.template(), 
+                         cycle_segments: ti.template(), 
+                         partner_edges: ti.template(), 
+                         live_edges: ti.template(), 
+                         live_edges_count: int, 
+                         cycle_number: int, 
+                         shape: ti.math.ivec2)\
+                         -> ti.math.ivec2: 
+    '''
+    Find the edges to stitch to merge a cycle with another one: the 
+    neighbours of the cycle are searched first, and all the edges of 
+    the other cycles only if there is no neighbour. 
 
+    Parameters 
+    ------
 
+    points, next_edge, cycle_index, cycle_parent, cycles, 
+    cycle_edges, cycle_segments, partner_edges, live_edges, live_edges_count : 
 
+        see find_edges_with_minimum_energy. 
+
+    cycle_number : int 
+
+        index of the cycle to stitch. 
+
+    shape: ti.math.ivec2
+
+        shape of the scalar field grid (useful to compute neighbours)
 
-@ti.kernel
-def compiled_stitching_algorithm_with_neighbours(points: ti.template(), 
-                                                 previous_edge: ti.template(),
-                                                 next_edge: ti.template(), 
-                                                 cycle_index: ti.template(), 
-                                                 cycles: ti.template(), 
-                                                 energies: ti.template(), 
-                                                 shape: ti.math.ivec2): 
 
+    Returns
+    ------
+
+    ti.math.ivec2: 
+
+        int vector containing 1D index of the the edges to stitch, 
+        the first one belonging to the cycle
     '''
-    Stitch all the cycles of a graph. This is the compiled function called in an non-compiled
-    one because we need to create the "energies" field. This version uses the optimisation.
+    gather_cycle_edges(points, 
+                       next_edge, 
+                       cycles, 
+                       cycle_number, 
+                       cycle_edges, 
+                       cycle_segments)
+    minimal_energy_edges = find_edges_with_minimum_energy_with_neighbours(points, 
+                                                                            next_edge, 
+                                                                            cycle_index, 
+                                                                            cycle_parent, 
+                                                                            cycle_edges, 
+                                                                            cycle_segments, 
+                                                                            cycles[cycle_number].y, 
+                                                                            partner_edges, 
+                                                                            shape)
+    #if we didn't find neighbours, use the classic method 
+    if minimal_energy_edges.x == -1: 
+        minimal_energy_edges = find_edges_with_minimum_energy(points, 
+                                                              next_edge, 
+                                                              cycle_index, 
+                                                              cycle_parent, 
+                                                              cycles, 
+                                                              cycle_edges, 
+                                                              cycle_segments, 
+                                                              partner_edges, 
+                                                              live_edges, 
+                                                              live_edges_count, 
+                                                              cycle_number)
+    return minimal_energy_edges
+
+def stitch_all_cycles_with_neighbourhood(points: ti.template(), 
+                                         previous_edge: ti.template(), 
+                                         next_edge: ti.template(), 
+                                         cycle_index: ti.template(), 
+                                         cycles: ti.template(), 
+                                         shape: ti.math.ivec2): 
+    '''
+    Version of the algorithm to be called from the Python scope.
+    It uses the optimisation. 
 
     Parameters 
     ------
@@ -492,11 +939,6 @@ def compiled_stitching_algorithm_with_neighbours(points: ti.template(),
         1D vector fields containing the length and starting edge of each cycle. 
         The starting edge is arbitrarily defined. 
 
-    energies : ti.template
-
-        Fields containing the value of the patching energy with the reference edge, 
-        arranged according to the edges of the grid. 
-    
     shape: ti.math.ivec2
 
         shape of the scalar field grid (useful to compute neighbours)
@@ -507,36 +949,50 @@ def compiled_stitching_algorithm_with_neighbours(points: ti.template(),
 
     None    
     '''
+    live_edges, live_edges_count, cycle_edges, cycle_segments, partner_edges, cycle_parent =\
+        start_stitching(points, 
+                        cycle_index, 
+                        cycles)
     nb_cycles = cycles.shape[0]
+    heap, lengths = build_cycle_heap(cycles)
 
-    
-    ti.loop_config(serialize= True)
     for _ in range(nb_cycles - 1): 
 
-        minimal_cycle_index = find_minimal_cycle(cycles, 
-                                                 nb_cycles)
-        minimal_energy_edges = find_edges_with_minimum_energy_with_neighbours(points, 
-                                                                                next_edge, 
-                                                                                cycle_index, 
-                                                                                cycles, 
-                                                                                energies, 
-                                                                                minimal_cycle_index, 
-                                                                                shape)
-        stitch_two_cycles(previous_edge, 
-                          next_edge, 
-                          cycle_index, 
-                          cycles, 
-                          minimal_energy_edges)
-        
-def stitch_all_cycles_with_neighbourhood(points: ti.template(), 
-                                         previous_edge: ti.template(), 
-                                         next_edge: ti.template(), 
-                                         cycle_index: ti.template(), 
-                                         cycles: ti.template(), 
-                                         shape: ti.math.ivec2): 
+        minimal_cycle_index = pop_minimal_cycle(heap, 
+                                                lengths)
+        minimal_energy_edges = find_stitching_edges(points, 
+                                                    next_edge, 
+                                                    cycle_index, 
+                                                    cycle_parent, 
+                                                    cycles, 
+                                                    cycle_edges, 
+                                                    cycle_segments, 
+                                                    partner_edges, 
+                                                    live_edges, 
+                                                    live_edges_count, 
+                                                    minimal_cycle_index, 
+                                                    shape)
+        stitched_cycles = stitch_two_cycles(previous_edge, 
+                                            next_edge, 
+                                            cycle_index, 
+                                            cycle_parent, 
+                                            cycles, 
+                                            minimal_energy_edges)
+        merge_cycle_lengths(heap, 
+                            lengths, 
+                            stitched_cycles.x, 
+                            stitched_cycles.y)
+
+    finish_stitching(cycle_index, 
+                     cycle_parent)
+
+@ti.kernel
+def compute_stitching_energy(points: ti.template(), 
+                             next_edge: ti.template(), 
+                             minimal_energy_edges: ti.math.ivec2)\
+                             -> float: 
     '''
-    Version of the algorithm to be called from the Python scope.
-    It uses the optimisation. 
+    Compute the patching energy of two edges, as in compute_cycle_energies. 
 
     Parameters 
     ------
@@ -546,42 +1002,165 @@ def stitch_all_cycles_with_neighbourhood(points: ti.template(),
         field containing the coordinates of all the points in the graph, 
         arranged according to the edges of the grid.
 
-    previous_edge: ti.template
-
-        field containing the previous edge of an edge in a cycle, 
-        arranged according to 1D indexes of the grid edges. 
-
     next_edge: ti.template
 
         field containing the next edge of an edge in a cycle, 
         arranged according to 1D indexes of the grid edges. 
 
+    minimal_energy_edges: ti.math.ivec2
+
+        vector of 1D index of the two edges. 
+
+
+    Returns
+    ------
+
+    float 
+
+        the patching energy 
+    '''
+    i_1 = points[minimal_energy_edges.x]
+    i_2 = points[next_edge[minimal_energy_edges.x]]
+    j_1 = points[minimal_energy_edges.y]
+    j_2 = points[next_edge[minimal_energy_edges.y]]
+
+    cross = sum_of_euclidean_norms(i_1 - j_2, i_2 - j_1) 
+    no_cross = sum_of_euclidean_norms(i_1 - j_1, i_2 - j_2)
+
+    return ti.min(cross, no_cross) - euclidean_norm(i_1 - i_2) - euclidean_norm(j_2 - j_1)
+
+@ti.kernel
+def find_edge_cycle(cycle_index: ti.template(), 
+                    cycle_parent: ti.template(), 
+                    edge: int) -> int: 
+    '''
+    Find the cycle currently holding an edge, see find_cycle_root. 
+
+    Parameters 
+    ------
+
     cycle_index: ti.template
 
         Fields containing the index of the cycle to which each edge belongs, 
         arranged according to 1D indexes of the grid edges.  
 
-    cycles: ti.template
+    cycle_parent: ti.template
 
-        1D vector fields containing the length and starting edge of each cycle. 
-        The starting edge is arbitrarily defined. 
+        1D field containing the cycle in which each cycle has been stitched, 
+        see find_cycle_root. 
 
-    shape: ti.math.ivec2
+    edge: int 
+
+        1D index of the edge. 
+
+
+    Returns
+    ------
+
+    int 
+
+        index of the cycle 
+    '''
+    return find_cycle_root(cycle_parent, 
+                           cycle_index[edge])
+
+def stitch_all_cycles_in_batches(points: ti.template(), 
+                                 previous_edge: ti.template(), 
+                                 next_edge: ti.template(), 
+                                 cycle_index: ti.template(), 
+                                 cycles: ti.template(), 
+                                 shape: ti.math.ivec2): 
+    '''
+    Version of the algorithm stitching several pairs of cycles at once. 
+    Each cycle keeps the edges with which it would be stitched, as found 
+    by find_stitching_edges. At each round, the pairs are taken by 
+    increasing energy, skipping the pairs involving a cycle already taken 
+    in the round, and all the pairs taken are stitched in parallel. Only 
+    the cycles whose pair involved a stitched cycle search new edges. 
+
+    The cycles are not stitched in the same order as in 
+    stitch_all_cycles_with_neighbourhood, so the final cycle can differ. 
+
+    Parameters 
+    ------
+
+    points, previous_edge, next_edge, cycle_index, cycles, shape : 
+
+        see stitch_all_cycles_with_neighbourhood. 
 
-        shape of the scalar field grid (useful to compute neighbours)
 
-        
     Returns
     ------
 
     None    
     '''
-    energies = ti.field(dtype= float, 
-                        shape = points.shape)
-    compiled_stitching_algorithm_with_neighbours(points, 
-                                                 previous_edge, 
-                                                 next_edge, 
-                                                 cycle_index, 
-                                                 cycles, 
-                                                 energies, 
-                                                 shape)
\ No newline at end of file
+    live_edges, live_edges_count, cycle_edges, cycle_segments, partner_edges, cycle_parent =\
+        start_stitching(points, 
+                        cycle_index, 
+                        cycles)
+    nb_cycles = cycles.shape[0]
+    batch_edges = ti.Vector.field(n = 2, 
+                                  dtype = int, 
+                                  shape = max(nb_cycles, 1))
+    batch_array = np.zeros((max(nb_cycles, 1), 2), 
+                           dtype = np.int32)
+
+    live_cycles = [cycle_number for cycle_number, length in enumerate(cycles.to_numpy()[:, 1]) 
+                   if length != 0]
+    #cycle -> (energy, cycle, other cycle, edges)
+    candidates = {}
+
+    while len(live_cycles) > 1: 
+
+        for cycle_number in live_cycles: 
+            if cycle_number not in candidates: 
+                edges = find_stitching_edges(points, 
+                                             next_edge, 
+                                             cycle_index, 
+                                             cycle_parent, 
+                                             cycles, 
+                                             cycle_edges, 
+                                             cycle_segments, 
+                                             partner_edges, 
+                                             live_edges, 
+                                             live_edges_count, 
+                                             cycle_number, 
+                                             shape)
+                candidates[cycle_number] = (compute_stitching_energy(points, 
+                                                                     next_edge, 
+                                                                     edges), 
+                                            cycle_number, 
+                                            find_edge_cycle(cycle_index, 
+                                                            cycle_parent, 
+                                                            edges.y), 
+                                            (edges.x, edges.y))
+
+        #greedy choice of pairs of cycles not sharing any cycle
+        taken_cycles = set()
+        stitched_pairs = []
+        for _, cycle_number, other_cycle_number, edges in sorted(candidates.values()): 
+            if cycle_number not in taken_cycles and other_cycle_number not in taken_cycles: 
+                taken_cycles.add(cycle_number)
+                taken_cycles.add(other_cycle_number)
+                batch_array[len(stitched_pairs)] = edges
+                stitched_pairs.append((cycle_number, other_cycle_number))
+
+        batch_edges.from_numpy(batch_array)
+        stitch_cycles_batch(previous_edge, 
+                            next_edge, 
+                            cycle_index, 
+                            cycle_parent, 
+                            cycles, 
+                            batch_edges, 
+                            len(stitched_pairs))
+
+        #the first cycle of each pair is kept, the other one is emptied, and the 
+        #pairs involving a stitched cycle are searched again at the next round
+        emptied_cycles = {other_cycle_number for _, other_cycle_number in stitched_pairs}
+        live_cycles = [cycle_number for cycle_number in live_cycles 
+                       if cycle_number not in emptied_cycles]
+        candidates = {cycle_number: candidate for cycle_number, candidate in candidates.items() 
+                      if cycle_number not in taken_cycles and candidate[2] not in taken_cycles}
+
+    finish_stitching(cycle_index, 
+                     cycle_parent)
@@ -2,13 +2,10 @@ import taichi as ti
 import numpy as np 
 import tqdm
 
-from svgpathtools import Line, Path, paths2svg
+from cglib.polylines import graph_to_cycle_order
 
 
 
-ti.init(arch = ti.cpu)
-
-
 
 def numpy_to_field(input_filename: str)\
                    -> ti.template(): 
@@ -33,9 +30,12 @@ def numpy_to_field(input_filename: str)\
         field containing the data of the file 
     '''
 
-    imported_arr = np.load(file = "data/fields/" + input_filename + ".npy")
-    arr = imported_arr.reshape(imported_arr.shape[1], imported_arr.shape[0])
-    arr = arr.T
+    #the file is mapped, its values are only read once by the copy below
+    imported_arr = np.load(file = "data/fields/" + input_filename + ".npy", 
+                           mmap_mode = 'r')
+    #the values are taken in column-major order, copied once into a C-contiguous 
+    #array that from_numpy does not need to repack 
+    arr = np.ascontiguousarray(imported_arr.reshape(imported_arr.shape[1], imported_arr.shape[0]).T)
     f = ti.field(dtype = float, shape = arr.shape)
     f.from_numpy(arr)
     return f
@@ -45,11 +45,18 @@ def data_structure_to_numpy(points: ti.template(),
                             next_edge: ti.template(), 
                             cycle_index: ti.template(), 
                             cycles: ti.template(), 
-                            file_name: str): 
+                            file_name: str, 
+                            points_array: np.ndarray = None)\
+                            -> np.ndarray: 
     
     '''
     Exports graph data to an .npz file. The output file will be 
     data/np/file_name.npz
+    The graph is stored in compressed sparse row form, see 
+    graph_to_cycle_order: the points of each cycle are stored one after 
+    the other in traversal order, with the 1D index of their edge. 
+    The other edges, previous_edge and cycle_index are not stored, 
+    they are rebuilt when loading, see csr_to_graph_arrays. 
 
     Parameters 
     -------
@@ -83,33 +90,122 @@ def data_structure_to_numpy(points: ti.template(),
 
         name of the output file 
 
+    points_array: np.ndarray 
+
+        optional copy of points returned by a previous call. The stitching 
+        does not move the points, so they do not have to be copied again. 
+
         
     Returns
     -------
 
-    None
+    np.ndarray
+
+        the coordinates of the points, which can be given to the next call 
     '''
 
-    
-    points_array = points.to_numpy()
-    next_edge_array = next_edge.to_numpy(dtype = int)
-    previous_edge_array = previous_edge.to_numpy(dtype = int)
-    cycle_index_array = cycle_index.to_numpy(dtype= int)
-    cycles_array = cycles.to_numpy(dtype = int)
+    if points_array is None: 
+        points_array = points.to_numpy()
+    order, offsets = graph_to_cycle_order(next_edge, 
+                                          cycles)
     output_file_name = "data/np/" + file_name
 
     np.savez(file=output_file_name, 
-             points = points_array, 
-             next_edge = next_edge_array, 
-             previous_edge = previous_edge_array, 
-             cycle_index = cycle_index_array, 
-             cycles = cycles_array)
+             points = points_array[order], 
+             order = order, 
+             offsets = offsets, 
+             edges_count = next_edge.shape[0])
+
+    return points_array
+
+def csr_to_graph_arrays(ordered_points: np.ndarray, 
+                        order: np.ndarray, 
+                        offsets: np.ndarray, 
+                        edges_count: int)\
+    -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray): 
+
+    '''
+    Rebuild the arrays of the graph from its compressed sparse row form, 
+    as saved by data_structure_to_numpy. The edges which do not belong 
+    to a cycle get the values set by to_graph. 
+
+    Parameters 
+    -------
+
+    ordered_points: np.ndarray
+
+        coordinates of the points of each cycle, in traversal order. 
+
+    order: np.ndarray
+
+        1D indexes of the edges of the points in ordered_points. 
+
+    offsets: np.ndarray
+
+        position of the first edge of each cycle in order, 
+        followed by the total number of edges. 
+
+    edges_count: int
 
-def numpy_contour_to_data_structure(file_name: str)\
-    -> (ti.template(), ti.template(), ti.template(), ti.template(),ti.template()): 
+        number of edges of the grid. 
+
+
+    Returns
+    -------
+
+    tuple (np.ndarray)
+    
+        arrays describing the graph
+        - points 
+        - previous_edge 
+        - next_edge 
+        - cycle_index 
+        - cycles 
+    '''
+
+    cycle_lengths = np.diff(offsets)
+    non_empty = cycle_lengths > 0
+
+    #position in order of the next edge, the last edge of a cycle is followed by its first one
+    next_position = np.arange(1, order.shape[0] + 1)
+    next_position[offsets[1:][non_empty] - 1] = offsets[:-1][non_empty]
+    next_order = order[next_position]
+
+    points_array = np.full((edges_count, 2), 
+                           np.nan, 
+                           dtype = ordered_points.dtype)
+    points_array[order] = ordered_points
+    next_edge_array = np.full(edges_count, 
+                              -1, 
+                              dtype = order.dtype)
+    next_edge_array[order] = next_order
+    previous_edge_array = np.full(edges_count, 
+                                  -1, 
+                                  dtype = order.dtype)
+    previous_edge_array[next_order] = order
+    cycle_index_array = np.full(edges_count, 
+                                -1, 
+                                dtype = order.dtype)
+    cycle_index_array[order] = np.repeat(np.arange(cycle_lengths.shape[0], dtype = order.dtype), 
+                                         cycle_lengths)
+
+    #the stitched cycles are empty and start at the edge 0
+    cycle_starts = np.zeros(cycle_lengths.shape[0], 
+                            dtype = order.dtype)
+    cycle_starts[non_empty] = order[offsets[:-1][non_empty]]
+    cycles_array = np.stack((cycle_starts, cycle_lengths.astype(order.dtype)), 
+                            axis = 1)
+
+    return points_array, previous_edge_array, next_edge_array, cycle_index_array, cycles_array
+
+def numpy_contour_to_cycles(file_name: str)\
+    -> (ti.template(), ti.template(), ti.template()): 
     
     '''
-    Imports graph data from an .npz file and stores it in fields. 
+    Imports the graph data needed to walk the cycles from an .npz file 
+    and stores them in fields. The members of the archive are read 
+    on access, so previous_edge and cycle_index are never read from 
+    the archives saved before the compressed sparse row form. 
 
     Parameters 
     -------
@@ -124,46 +220,111 @@ def numpy_contour_to_data_structure(file_name: str)\
 
     tuple (ti.template)
     
-        fields describing the graph
+        fields describing the cycles of the graph
+        - points 
+        - next_edge 
+        - cycles 
+    
+    '''
+
+    return cycle_arrays_to_fields(*numpy_contour_to_cycle_arrays(file_name))
+
+def numpy_contour_to_cycle_arrays(file_name: str)\
+    -> (np.ndarray, np.ndarray, np.ndarray): 
+    
+    '''
+    First half of numpy_contour_to_cycles, which only reads the arrays 
+    and does not use Taichi. It can therefore run in another thread 
+    than the one launching the kernels. 
+
+    Parameters 
+    -------
+    
+    file_name
+
+        name of the .npz file where the data are stored. 
+
+        
+    Returns
+    -------
+
+    tuple (np.ndarray)
+    
+        arrays describing the cycles of the graph
         - points 
-        - preivous_edge 
         - next_edge 
-        - cycle_index 
         - cycles 
     
     '''
 
     filepath = "data/np/" + file_name + ".npz"
-    npz_file = np.load(filepath)
+
+    with np.load(filepath) as npz_file: 
+        if "order" in npz_file.files: 
+            points_array, _, next_edge_array, _, cycles_array =\
+                csr_to_graph_arrays(npz_file["points"], 
+                                    npz_file["order"], 
+                                    npz_file["offsets"], 
+                                    int(npz_file["edges_count"]))
+        else: 
+            points_array = npz_file["points"]
+            next_edge_array = npz_file["next_edge"]
+            cycles_array = npz_file["cycles"]
+
+    return points_array, next_edge_array, cycles_array
+
+def cycle_arrays_to_fields(points_array: np.ndarray, 
+                           next_edge_array: np.ndarray, 
+                           cycles_array: np.ndarray)\
+    -> (ti.template(), ti.template(), ti.template()): 
+    
+    '''
+    Second half of numpy_contour_to_cycles, which copies the arrays 
+    to new fields. 
+
+    Parameters 
+    -------
+    
+    points_array, next_edge_array, cycles_array: np.ndarray
+
+        arrays returned by numpy_contour_to_cycle_arrays. 
+
+        
+    Returns
+    -------
+
+    tuple (ti.template)
     
+        fields describing the cycles of the graph
+        - points 
+        - next_edge 
+        - cycles 
+    
+    '''
 
     points = ti.Vector.field(n=2, 
                              dtype=float, 
-                             shape=npz_file["previous_edge"].shape) 
-    previous_edge= ti.field(dtype = int, 
-                            shape = npz_file["previous_edge"].shape)
+                             shape=next_edge_array.shape, 
+                             layout=ti.Layout.SOA) 
     next_edge= ti.field(dtype = int, 
-                        shape = npz_file["previous_edge"].shape)
-    cycle_index = ti.field(dtype = int, 
-                           shape = npz_file["previous_edge"].shape) 
+                        shape = next_edge_array.shape)
     cycles = ti.Vector.field(n = 2, 
                              dtype = int, 
-                             shape = npz_file["cycles"].shape[0])
+                             shape = cycles_array.shape[0], 
+                             layout = ti.Layout.SOA)
 
-    points.from_numpy(npz_file["points"])
-    previous_edge.from_numpy(npz_file["previous_edge"])
-    next_edge.from_numpy(npz_file["next_edge"])
-    cycle_index.from_numpy(npz_file["cycle_index"])
-    cycles.from_numpy(npz_file["cycles"])
+    points.from_numpy(points_array)
+    next_edge.from_numpy(next_edge_array)
+    cycles.from_numpy(cycles_array)
 
-    return points, previous_edge, next_edge, cycle_index, cycles
+    return points, next_edge, cycles
 
 def data_structure_to_svg(points: ti.template(), 
                           next_edge: ti.template(), 
                           cycles: ti.template(), 
                           output_name: str): 
     '''
-    Exports graph data to a SVG file. 
+    Exports graph data to a SVG file, each cycle being a closed path. 
 
     Parameters 
     -------
@@ -194,38 +355,41 @@ def data_structure_to_svg(points: ti.template(),
     None
     '''
 
-    def vector_to_complex(vec: ti.math.vec2)\
-                         -> complex: 
-        return vec.x + 1j * vec.y
-        
-
-    paths = []
-
-    for cycle_number in tqdm.tqdm(range(cycles.shape[0])): 
-
-        cycle = cycles[cycle_number]
-        
-        path_i = Path()
-        start_edge_index = cycle.x
-
-        if cycle.y != 0: 
-
-            for _ in range(cycle.y): #cycle[1] = longueur du cycle
-
-                end_edge_index = next_edge[start_edge_index]
-                
-                
-                start_point = points[start_edge_index]
-                end_point = points[end_edge_index]
-
-                line = Line(vector_to_complex(start_point), 
-                            vector_to_complex(end_point))
-                path_i.append(line)
-                start_edge_index = end_edge_index
-            
-            paths.append(path_i)
-
-        cycle_number +=1 
-
-    paths2svg.wsvg(paths, 
-                   filename= "data/svg_files/" + output_name + ".svg")
\ No newline at end of file
+    #the cycles are ordered on the device, then each of them is written 
+    #as a single path, so the file is streamed instead of built in memory
+    points_array = points.to_numpy()
+    order, offsets = graph_to_cycle_order(next_edge, 
+                                          cycles)
+    ordered_points = points_array[order]
+
+    #the stitched cycles are empty, they are skipped before the loop
+    cycle_numbers = np.flatnonzero(np.diff(offsets)).tolist()
+
+    #bounding box of the points with a margin of a tenth of its size
+    if ordered_points.shape[0] > 0: 
+        minimum = ordered_points.min(axis = 0)
+        size = ordered_points.max(axis = 0) - minimum
+    else: 
+        minimum = np.zeros(2)
+        size = np.ones(2)
+    size = np.where(size > 0, size, 1.)
+    view_box = np.concatenate((minimum - size / 10, size * 1.2))
+    stroke_width = size.max() / 1000
+
+    with open("data/svg_files/" + output_name + ".svg", "w") as svg_file: 
+        svg_file.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+        svg_file.write('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" ' 
+                       'width="600px" height="%dpx" viewBox="%f %f %f %f">\n' 
+                       % ((int(np.ceil(600 * view_box[3] / view_box[2])),) + tuple(view_box.tolist())))
+
+        #the progress bar is refreshed about a hundred times in total
+        for cycle_number in tqdm.tqdm(cycle_numbers, 
+                                      miniters = max(1, len(cycle_numbers) // 100)): 
+
+            cycle_points = ordered_points[offsets[cycle_number]:offsets[cycle_number + 1]]
+            #the path goes back to its first point, as the cycle does
+            path = ("%f,%f L " * (cycle_points.shape[0] - 1) + "%f,%f Z") % tuple(cycle_points.ravel().tolist())
+            svg_file.write('<path d="M %s" fill="none" stroke="#000000" stroke-width="%f" />\n' 
+                           % (path, stroke_width))
+
+        svg_file.write('</svg>\n')
@@ -3,12 +3,8 @@ import time
 import argparse
 
 from cglib.type import numpy_to_field, data_structure_to_numpy
-from cglib.graph import to_graph
-from cglib.stitch import stitch_all_cycles_with_neighbourhood
-
-
-
-ti.init(arch = ti.cpu)
+from cglib.graph import to_graph, init_backend
+from cglib.stitch import stitch_all_cycles_with_neighbourhood, stitch_all_cycles_in_batches
 
 
 
@@ -18,10 +14,29 @@ if __name__ == "__main__":
     parser.add_argument("input_filename", 
                         help= "File in .npy format containing a scalar field whose isocontours we want to extract and stitch. ", 
                         type = str)
+    #the stitching needs 64-bit integer atomics, so gpu means CUDA, 
+    #which falls back to the CPU when it is not available
+    parser.add_argument("--arch", 
+                        help= "Taichi backend running the kernels. ", 
+                        default = "gpu", 
+                        choices = ["cpu", "gpu", "cuda"])
+    #trades the speed of the kernels for a shorter first compilation, 
+    #e.g. while developing. The kernels are cached on disk in any case
+    parser.add_argument("--fast-compile", 
+                        help= "Skip the advanced optimisation passes of the Taichi compiler. ", 
+                        action = "store_true")
+    parser.add_argument("--batch", 
+                        help= "Stitch several pairs of cycles at once, the stitched cycle can differ. ", 
+                        action = "store_true")
 
     args = parser.parse_args()
     file_name = args.input_filename
 
+    #the only ti.init of the run, the compiled kernels are kept on disk between runs
+    init_backend(args.arch, 
+                 offline_cache = True, 
+                 advanced_optimization = not args.fast_compile)
+
     try: 
         
         #get the graph 
@@ -34,23 +49,24 @@ if __name__ == "__main__":
 
         #save the graph 
         start_data = time.perf_counter()
-        data_structure_to_numpy(points, 
-                                previous_edge, 
-                                next_edge, 
-                                cycle_index, 
-                                cycles, 
-                                file_name + "_contour")
+        points_array = data_structure_to_numpy(points, 
+                                               previous_edge, 
+                                               next_edge, 
+                                               cycle_index, 
+                                               cycles, 
+                                               file_name + "_contour")
         end_data = time.perf_counter()
         print("Contours data saved in  " + str(end_data-start_data) + " seconds\n")
 
         #stitch the graph and get a single cycle 
         start_data = time.perf_counter()
-        stitch_all_cycles_with_neighbourhood(points, 
-                                             previous_edge, 
-                                             next_edge,
-                                             cycle_index, 
-                                             cycles, 
-                                             ti.math.ivec2(grid.shape[0], grid.shape[1]))
+        stitch_all_cycles = stitch_all_cycles_in_batches if args.batch else stitch_all_cycles_with_neighbourhood
+        stitch_all_cycles(points, 
+                          previous_edge, 
+                          next_edge,
+                          cycle_index, 
+                          cycles, 
+                          ti.math.ivec2(grid.shape[0], grid.shape[1]))
         end_data = time.perf_counter()
         print("Stitching algorithm runtime : " + str(-start_data+end_data) + " seconds\n")
         
@@ -62,7 +78,8 @@ if __name__ == "__main__":
                                 next_edge, 
                                 cycle_index, 
                                 cycles, 
-                                file_name + "_cycle")       
+                                file_name + "_cycle", 
+                                points_array)       
         end_data = time.perf_counter()
         print("Cycle data saved in " + str(end_data-start_data) + " seconds\n")
 
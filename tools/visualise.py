@@ -1,140 +1,197 @@
 import taichi as ti 
-import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 
+from cglib.cli import make_parser
 from cglib.polylines import graph_to_polylines
-from cglib.fields import normalize_grid, compute_pixels, shift_lines
-from cglib.type import numpy_to_field, numpy_contour_to_data_structure
-from cglib.graph import compute_binary_grid
+from cglib.fields import normalize_and_paint, build_viridis_lut
+from cglib.type import numpy_to_field, numpy_contour_to_cycle_arrays, cycle_arrays_to_fields
 
 
 
-ti.init(arch = ti.cpu)
+#the pixels stay in device memory, so that the canvas does not upload them 
+#from the host at each frame. ti.gpu falls back to the CPU when no GPU 
+#backend is available. fast_math lets the backend fuse the Horner scheme 
+#of the colour map into fma
+ti.init(arch = ti.gpu, 
+        fast_math = True)
+
+
+
+def prepare_overlays(archives: list, 
+                     shift: float)\
+                     -> tuple: 
+    '''
+    Turn the isocontours and the stitched cycle saved by the main tool 
+    into polylines ready to be displayed. 
+
+    Parameters 
+    -------
+
+    archives: list 
+
+        the futures of numpy_contour_to_cycle_arrays for the isocontours 
+        and for the stitched cycle, which raise FileNotFoundError if 
+        the main tool was not run. 
+
+    shift : float 
+
+        offset applied to both coordinates of the lines, see graph_to_polylines. 
+
+
+    Returns
+    -------
+
+    tuple
+
+        the polylines of the isocontours and the polylines of the 
+        stitched cycle. 
+    '''
+    #get the contour data, the fields are created in the thread running the kernels
+    points, next_edge, cycles =\
+          cycle_arrays_to_fields(*archives[0].result())
+    points_stitched, next_edge_stitched, cycles_stitched =\
+          cycle_arrays_to_fields(*archives[1].result())
+
+    #transform the graph data structure into shifted polylines
+    lines = graph_to_polylines(points, 
+                               next_edge, 
+                               cycles, 
+                               shift)
+    lines_stitched = graph_to_polylines(points_stitched,
+                                        next_edge_stitched, 
+                                        cycles_stitched, 
+                                        shift)
+
+    return lines, lines_stitched
+
+def render_loop(window: ti.ui.Window, 
+                canvas: ti.ui.Canvas, 
+                pixels, 
+                lines_a, 
+                lines_b, 
+                initial_switch: int): 
+    '''
+    Display the scalar field with one of the two sets of lines on top 
+    of it, until the window is closed. The other set is displayed 
+    while the space bar is pressed. 
+
+    Parameters 
+    -------
+
+    window: ti.ui.Window 
+
+        the window in which everything is displayed. 
+
+    canvas: ti.ui.Canvas 
+
+        the canvas of the window. 
+
+    pixels
+
+        2D square field containing the colours of the scalar field. 
+
+    lines_a, lines_b
+
+        1D Vector fields containing the coordinates of the points 
+        forming the polylines, see graph_to_polylines. 
+
+    initial_switch: int 
+
+        1 to display lines_a when the space bar is released, 
+        -1 to display lines_b. 
+
+
+    Returns
+    -------
+
+    None
+    '''
+    switch = initial_switch
+    displayed_lines = lines_a if switch == 1 else lines_b
+    while window.running: 
+        #the switch only changes when the space bar is pressed or released
+        for event in window.get_events(): 
+            if event.key == ti.ui.SPACE: 
+                switch = -initial_switch if event.type == ti.ui.PRESS else initial_switch
+                displayed_lines = lines_a if switch == 1 else lines_b
+
+        canvas.set_image(pixels)
+        canvas.lines(displayed_lines, 
+                     color=(0., 0.99, 0.), 
+                     width=.001)
+        window.show()
 
 
 
 if __name__ == "__main__": 
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input_filename", 
-                        help= "File in .npy format containing the scalar field to be displayed.")
-    parser.add_argument("datatosee", 
-                        help= "display the scalar field (scalar), a single stitched cycle (cycle),\
-                              or all the isocontours of the scalar field (contour). ")
+    parser = make_parser("datatosee", 
+                         "display the scalar field (scalar), a single stitched cycle (cycle), " 
+                         "or all the isocontours of the scalar field (contour). ", 
+                         ("scalar", "contour", "cycle"))
 
     args = parser.parse_args()
 
     file_name = args.input_filename
     data_to_see = args.datatosee
     
+    #both archives are read in the background while the scalar field 
+    #is painted and the window is created, Taichi stays in this thread
+    if data_to_see != "scalar": 
+        executor = ThreadPoolExecutor(max_workers = 2)
+        archives = [executor.submit(numpy_contour_to_cycle_arrays, 
+                                    file_name + suffix) 
+                    for suffix in ("_contour", "_cycle")]
+        #does not wait for the reads, the threads end with them
+        executor.shutdown(wait = False)
 
     #get the scalar field and put it in a square grid, to be displayed in a square window. 
     grid = numpy_to_field(file_name)
-    normalize_grid(grid)
+    side = max(grid.shape[0], grid.shape[1])
+    #half a cell, the offset of the scalar field display 
+    shift = 1. / (2 * side)
+    #8 bits per channel, the precision of the image displayed by the canvas. 
+    #the grid covers pixels entirely when it is square, there is no margin to paint
     pixels = ti.Vector.field(n = 3, 
-                            dtype = float, 
-                            shape = (ti.math.max(grid.shape[0], grid.shape[1]), 
-                                    ti.math.max(grid.shape[0], grid.shape[1])))
-    compute_pixels(pixels, 
-                    grid)
+                            dtype = ti.u8, 
+                            shape = (side, side))
+    normalize_and_paint(pixels, 
+                        grid, 
+                        build_viridis_lut())
     
-    #create th window and the canvas 
-    window = ti.ui.Window("Affichage", (1500, 1500))
+    #create th window and the canvas, the frames are paced by the display refresh
+    window = ti.ui.Window("Affichage", 
+                          (1500, 1500), 
+                          vsync = True)
     canvas = window.get_canvas()
 
 
     # display the scalar field 
     if data_to_see == "scalar": 
 
+        #the frame is rebuilt at each show, so the image is set again 
+        #at each frame even if pixels does not change 
         while window.running: 
             canvas.set_image(pixels)
             window.show()
         
-    #display the contour
-    elif data_to_see == "contour": 
+    #display the contour or the single cycle, and the other one while the space bar 
+    #is pressed. datatosee is checked by the parser
+    else: 
 
         try: 
-            switch = 1 
-            
-            #get the contour data
-            points, previous_edge, next_edge, cycle_index, cycles =\
-                  numpy_contour_to_data_structure(file_name + "_contour")
-            points_stitched, previous_edge_stitched, next_edge_stitched, cycle_index_stitched, cycles_stitched =\
-                  numpy_contour_to_data_structure(file_name + "_cycle")
-
-            #transform the graph data structure into polylines
-            lines = graph_to_polylines(points, 
-                                       next_edge, 
-                                       cycles)
-            shift_lines(grid, 
-                        lines)
-            lines_stitched = graph_to_polylines(points_stitched,
-                                                next_edge_stitched,
-                                                cycles_stitched)
-            shift_lines(grid,
-                        lines_stitched)   
-            
-            while window.running: 
-                canvas.set_image(pixels)
-                if window.is_pressed(" "): 
-                    switch = -1
-                else: 
-                    switch = 1
-
-                if switch == 1: 
-                    canvas.lines(lines, 
-                                 color=(0., 0.99, 0.), 
-                                 width=.001)
-                else: 
-                    canvas.lines(lines_stitched, 
-                                 color=(0., 0.99, 0.), 
-                                 width=.001)
-                window.show()
-
+            lines, lines_stitched = prepare_overlays(archives, 
+                                                     shift)
         except FileNotFoundError: 
-            print("Please run the main tool before displaying the stitched cycle")
-
-    #display the single cycle
-    elif data_to_see == "cycle": 
-        
-        try: 
-            switch = -1 
-            
-            points, previous_edge, next_edge, cycle_index, cycles =\
-                  numpy_contour_to_data_structure(file_name + "_contour")
-            points_stitched, previous_edge_stitched, next_edge_stitched, cycle_index_stitched, cycles_stitched =\
-                  numpy_contour_to_data_structure(file_name + "_cycle")
-
-            lines = graph_to_polylines(points, 
-                                       next_edge, 
-                                       cycles)
-            shift_lines(grid, 
-                        lines)
-            lines_stitched = graph_to_polylines(points_stitched,
-                                                next_edge_stitched, 
-                                                cycles_stitched)
-            shift_lines(grid, 
-                        lines_stitched)
-            
-            while window.running: 
-                canvas.set_image(pixels)
-                if window.is_pressed(" "): 
-                    switch = 1
-                else: 
-                    switch = -1
-
-                if switch == 1: 
-                    canvas.lines(lines, 
-                                 color=(0., 0.99, 0.), 
-                                 width=.001)
-                else: 
-                    canvas.lines(lines_stitched, 
-                                 color=(0., 0.99, 0.), 
-                                 width=.001)
-                window.show()
-
-        except FileNotFoundError: 
-            print("Please run the main tool before displaying the isocontour of the scalar field.")
-
-    else: 
-        print('Please enter either contour, cycle or scalar as the second argument.')
\ No newline at end of file
+            if data_to_see == "contour": 
+                print("Please run the main tool before displaying the stitched cycle")
+            else: 
+                print("Please run the main tool before displaying the isocontour of the scalar field.")
+        else: 
+            render_loop(window, 
+                        canvas, 
+                        pixels, 
+                        lines, 
+                        lines_stitched, 
+                        1 if data_to_see == "contour" else -1)